@@ -1,28 +1,36 @@
 import logging
+import multiprocessing
 import os
-from flask import Flask
-from app.data_ingestor import DataIngestor
+from app.query_cache import QueryCache
+from app.rate_limiter import create_rate_limiter
+from app.server import Webserver
 from app.task_runner import ThreadPool
 from logging.handlers import RotatingFileHandler
 
-webserver = Flask(__name__)
+CSV_PATH = "./nutrition_activity_obesity_usa_subset.csv"
 
-webserver.tasks_runner = ThreadPool()
+# The dataset is loaded on first use (see Webserver), not when the app is imported
+webserver = Webserver(__name__, CSV_PATH)
 
-webserver.data_ingestor = DataIngestor("./nutrition_activity_obesity_usa_subset.csv")
+# The cache is emptied whenever a new dataset is loaded
+webserver.query_cache = QueryCache(lambda: webserver.data_ingestor.version)
 
-webserver.job_counter = 1
+# Per-client limit of the POST requests, disabled unless RATE_LIMIT is set
+webserver.rate_limiter = create_rate_limiter()
 
-from app import routes
+webserver.tasks_runner = ThreadPool(webserver.query_cache, csv_path=CSV_PATH,
+									dataset=lambda: webserver.data_ingestor)
+
+# Loaded in the background unless DATA_PRELOAD is set to 0. The worker processes of the
+# process backend get the dataset from the server instead (see init_worker)
+if os.environ.get('DATA_PRELOAD', '1') == '1' and multiprocessing.parent_process() is None:
+	webserver.preload()
 
-# Creating 'results' directory if it doesn't exist
-if not os.path.exists('results'):
-	os.mkdir('results')
+from app import routes
 
-# Creating 'webserver.log' file if it doesn't exist
-if not os.path.exists('webserver.log'):
-	with open('webserver.log', 'w') as f:
-		pass
+# The jobs saved by the drain of the previous start, if JOB_QUEUE_FILE is set
+if multiprocessing.parent_process() is None:
+	webserver.tasks_runner.resume(routes.RESUMABLE_QUERIES)
 
 # Setting up logging for the web server
 webserver.logger = logging.getLogger('webserver_logger')
@@ -33,8 +41,9 @@ webserver.logger.setLevel(logging.DEBUG)
 # Creating a formatter with a specific format for log messages GMT time
 formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 
-# Creating a file handler that rotates log files when they reach 0.2 MB
-handler = RotatingFileHandler('./webserver.log', maxBytes=20000, backupCount=5)
+# Creating a file handler that rotates log files when they reach 0.2 MB, the file is only
+# opened when the first message is logged
+handler = RotatingFileHandler('./webserver.log', maxBytes=20000, backupCount=5, delay=True)
 
 # Setting the formatter for the file handler
 handler.setFormatter(formatter)
@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+try:
+	import pyarrow
+except ImportError:
+	pyarrow = None
+
+class ColumnCache:
+	"""
+	Class representing a binary columnar copy of a CSV file, saved next to it so the next
+	starts load the columns instead of parsing the CSV again. The columns are saved as a
+	Feather file if pyarrow is installed, otherwise as one .npy file per column (the codes
+	for the categorical columns, whose categories are kept in the metadata).
+
+	The copy is only used while the CSV has the size, modification time and content hash it
+	had when the copy was saved.
+	"""
+	def __init__(self, csv_path):
+		"""
+		Initialize the ColumnCache of a CSV file.
+
+		Parameters:
+			csv_path (str): The path to the CSV file.
+		"""
+		self.csv_path = csv_path
+		self.directory = f"{csv_path}.cache"
+		self.metadata_path = os.path.join(self.directory, "metadata.json")
+
+	def content_hash(self):
+		"""
+		Hash the content of the CSV file.
+
+		Returns:
+			str: The SHA-256 hex digest of the file.
+		"""
+		digest = hashlib.sha256()
+		with open(self.csv_path, "rb") as f:
+			for chunk in iter(lambda: f.read(1 << 20), b""):
+				digest.update(chunk)
+		return digest.hexdigest()
+
+	def write_metadata(self, metadata):
+		"""
+		Atomically replace the metadata of the cached columns.
+
+		Parameters:
+			metadata (dict): The metadata saved with the columns.
+
+		Returns:
+			None
+		"""
+		with open(f"{self.metadata_path}.tmp", "w") as f:
+			json.dump(metadata, f)
+		os.replace(f"{self.metadata_path}.tmp", self.metadata_path)
+
+	def is_valid(self, metadata):
+		"""
+		Check that the cached columns were saved from the current content of the CSV file. The
+		content is only hashed if the size matches but the modification time does not, and the
+		new modification time is then recorded so the file is not hashed on every start.
+
+		Parameters:
+			metadata (dict): The metadata saved with the columns.
+
+		Returns:
+			bool: True if the cached columns can be used.
+		"""
+		stat = os.stat(self.csv_path)
+		if stat.st_size != metadata["size"]:
+			return False
+		if stat.st_mtime_ns == metadata["mtime_ns"]:
+			return True
+		if self.content_hash() != metadata["sha256"]:
+			return False
+
+		try:
+			self.write_metadata(dict(metadata, mtime_ns=stat.st_mtime_ns))
+		except OSError:
+			pass
+		return True
+
+	def load(self):
+		"""
+		Load the cached columns.
+
+		Returns:
+			pandas.DataFrame: The columns, or None if there is no valid copy of the CSV file.
+		"""
+		try:
+			with open(self.metadata_path) as f:
+				metadata = json.load(f)
+			if not self.is_valid(metadata):
+				return None
+
+			if metadata["format"] == "feather":
+				return pd.read_feather(os.path.join(self.directory, "data.feather"))
+
+			columns = {}
+			for column, categories in metadata["columns"].items():
+				values = np.load(os.path.join(self.directory, f"{column}.npy"))
+				if categories is not None:
+					values = pd.Categorical.from_codes(values, categories, validate=False)
+				columns[column] = values
+			return pd.DataFrame(columns, copy=False)
+		except (OSError, ValueError, KeyError):
+			# Missing, partial or unreadable copy, the CSV is parsed again
+			return None
+
+	def save(self, data):
+		"""
+		Save the columns loaded from the CSV file. The metadata is written last, so a partial
+		copy is never used.
+
+		Parameters:
+			data (pandas.DataFrame): The columns loaded from the CSV file.
+
+		Returns:
+			bool: True if the columns were saved.
+		"""
+		try:
+			os.makedirs(self.directory, exist_ok=True)
+			if os.path.exists(self.metadata_path):
+				os.remove(self.metadata_path)
+
+			stat = os.stat(self.csv_path)
+			metadata = {
+				"size": stat.st_size,
+				"mtime_ns": stat.st_mtime_ns,
+				"sha256": self.content_hash(),
+				"format": "feather" if pyarrow is not None else "npy",
+				"columns": {},
+			}
+
+			if pyarrow is not None:
+				data.to_feather(os.path.join(self.directory, "data.feather"))
+			else:
+				for column in data.columns:
+					values = data[column]
+					if isinstance(values.dtype, pd.CategoricalDtype):
+						metadata["columns"][column] = list(values.cat.categories)
+						values = np.asarray(values.array.codes)
+					else:
+						metadata["columns"][column] = None
+						values = values.to_numpy()
+					np.save(os.path.join(self.directory, f"{column}.npy"), values)
+
+			self.write_metadata(metadata)
+			return True
+		except OSError:
+			# Read-only directory or full disk, the CSV is parsed again on the next start
+			return False
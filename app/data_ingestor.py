@@ -1,18 +1,68 @@
+import io
+import itertools
+import math
+import os
+from threading import Lock
+
 import pandas as pd
+from pandas.api.types import union_categoricals
+
+from app.column_cache import ColumnCache
+
+# Only the columns used by the routes are loaded, the dimension columns as categoricals
+SCHEMA = {
+	'Question': 'category',
+	'LocationDesc': 'category',
+	'StratificationCategory1': 'category',
+	'Stratification1': 'category',
+	'Data_Value': 'float64',
+}
+
+DIMENSIONS = [column for column, dtype in SCHEMA.items() if dtype == 'category']
 
 class DataIngestor:
 	"""
 	Class responsible for ingesting data from a CSV file.
 	"""
-	def __init__(self, csv_path: str):
+	# Every loaded dataset gets a new version, used to invalidate derived caches
+	versions = itertools.count(1)
+
+	def __init__(self, csv_path: str, data=None, index=None, chunk_size=None):
 		"""
 		Initialize the DataIngestor with the path to the CSV file.
 
+		In streaming mode, enabled by a chunk size (by default the one defined in the environment
+		variable DATA_CHUNK_SIZE, 0 to disable it), the CSV is read in chunks of that many rows
+		that are folded into the aggregate index, so the data is never held in memory at once
+		and self.data is None.
+
 		Parameters:
 			csv_path (str): The path to the CSV file containing the data.
+			data (pandas.DataFrame): The data already loaded from the CSV file, if any.
+			index (dict): The aggregate index already built from the data, if any.
+			chunk_size (int): The number of rows read at once in streaming mode.
 		"""
+		self.csv_path = csv_path
+		self.version = next(DataIngestor.versions)
+		if chunk_size is None:
+			chunk_size = int(os.environ.get('DATA_CHUNK_SIZE', 0))
+		self.chunk_size = chunk_size
+
+		# Rows appended since the data was last read, concatenated to it on the next read
+		self.appended = []
+		self.append_lock = Lock()
+
 		# Read csv from csv_path
-		self.data = pd.read_csv(csv_path)
+		if data is None and not self.chunk_size:
+			data = self.read_csv(csv_path)
+		self.data = data
+
+		# Integer code of every value of the dimension columns, so filters compare ints
+		self.codes = {}
+		if self.data is not None:
+			self.codes = {column: {value: code for code, value
+								   in enumerate(self.data[column].cat.categories)}
+						  for column in DIMENSIONS}
 
 		self.questions_best_is_min = [
 			'Percent of adults aged 18 years and older who have an overweight classification',
@@ -30,3 +80,456 @@ class DataIngestor:
 		]
 
 		self.questions = self.questions_best_is_min + self.questions_best_is_max
+
+		# Aggregate index built once, so the routes only do dictionary lookups
+		self.index = index if index is not None else self.build_index()
+
+		# Matrices of all the questions, built on the first request that needs them
+		self.matrices = None
+
+	@property
+	def data(self):
+		"""
+		The loaded rows, or None in streaming mode. The rows appended since the last read are
+		concatenated to them first.
+		"""
+		if self.appended:
+			with self.append_lock:
+				self.merge_appended()
+		return self.frame
+
+	@data.setter
+	def data(self, data):
+		self.frame = data
+
+	@staticmethod
+	def read_csv(csv_path):
+		"""
+		Load the columns of the CSV file, from its binary columnar copy if it has one. Otherwise
+		the CSV is parsed and the copy is saved for the next starts, unless the environment
+		variable DATA_CACHE is set to 0.
+
+		Parameters:
+			csv_path (str): The path to the CSV file containing the data.
+
+		Returns:
+			pandas.DataFrame: The loaded columns.
+		"""
+		if os.environ.get('DATA_CACHE', '1') == '0':
+			return pd.read_csv(csv_path, usecols=list(SCHEMA), dtype=SCHEMA)
+
+		cache = ColumnCache(csv_path)
+		data = cache.load()
+		if data is None:
+			data = pd.read_csv(csv_path, usecols=list(SCHEMA), dtype=SCHEMA)
+			cache.save(data)
+		return data
+
+	def build_index(self):
+		"""
+		Build the per-question aggregate index holding the sum and count of 'Data_Value' for
+		every question, question x state and question x state x stratification, from the
+		loaded data or, in streaming mode, from the chunks of the CSV file.
+
+		Returns:
+			dict: A dictionary mapping each question to its QuestionIndex.
+		"""
+		if self.data is not None:
+			return index_frame(self.data)
+
+		index = {}
+		for chunk in pd.read_csv(self.csv_path, usecols=list(SCHEMA), dtype=SCHEMA,
+								 chunksize=self.chunk_size):
+			merge_index(index, index_frame(chunk))
+
+		# Same order of the states as when the data is grouped at once
+		for question_index in index.values():
+			question_index.states = dict(sorted(question_index.states.items()))
+			question_index.categories = {state: dict(sorted(categories.items()))
+										 for state, categories
+										 in sorted(question_index.categories.items())}
+		return index
+
+	def append(self, rows):
+		"""
+		Append new rows to the dataset. Only the aggregates of the new rows are computed, then
+		folded into copies of the aggregates of their questions. The loaded rows, which the
+		indexed queries never read, are not rebuilt: the new rows are kept aside until the
+		next read of data, which concatenates all of them at once. The cost of an append thus
+		depends on the number of new rows and the number of their questions, not on the size
+		of the dataset. The new index is swapped in before the version changes, so a query
+		never caches a result of the previous data under the new version.
+
+		Parameters:
+			rows (pandas.DataFrame): The new rows, with at least the columns of SCHEMA.
+
+		Returns:
+			int: The number of appended rows.
+
+		Raises:
+			ValueError: If a column is missing or has invalid values.
+		"""
+		missing = [column for column in SCHEMA if column not in rows.columns]
+		if missing:
+			raise ValueError(f"Missing columns: {', '.join(missing)}")
+		rows = rows[list(SCHEMA)].astype(SCHEMA).reset_index(drop=True)
+
+		with self.append_lock:
+			new_index = index_frame(rows)
+			index = dict(self.index)
+			for question in new_index:
+				if question in index:
+					index[question] = index[question].copy()
+			merge_index(index, new_index)
+
+			if self.frame is not None:
+				self.appended = self.appended + [rows]
+
+			self.index = index
+			self.matrices = None
+			self.version = next(DataIngestor.versions)
+
+		return len(rows)
+
+	def merge_appended(self):
+		"""
+		Concatenate the appended rows to the loaded ones. Must be called with the append lock
+		held.
+
+		Returns:
+			None
+		"""
+		if not self.appended:
+			return
+
+		frames = [self.frame] + self.appended
+		# The categories of the new values are added at the end, the codes don't change
+		data = pd.DataFrame({column: union_categoricals([frame[column].array for frame in frames])
+							 if column in DIMENSIONS
+							 else pd.concat([frame[column] for frame in frames], ignore_index=True)
+							 for column in SCHEMA})
+		self.codes = {column: {value: code for code, value
+							   in enumerate(data[column].cat.categories)}
+					  for column in DIMENSIONS}
+		self.frame = data
+		self.appended = []
+
+	def append_text(self, text, lines_format):
+		"""
+		Append new rows given as CSV or as JSON lines.
+
+		Parameters:
+			text (str): The rows, CSV with a header line or one JSON object per line.
+			lines_format (str): 'csv' or 'jsonl'.
+
+		Returns:
+			int: The number of appended rows.
+
+		Raises:
+			ValueError: If the rows can not be parsed.
+		"""
+		if lines_format == 'csv':
+			rows = pd.read_csv(io.StringIO(text))
+		elif lines_format == 'jsonl':
+			rows = pd.read_json(io.StringIO(text), lines=True, dtype=False)
+		else:
+			raise ValueError(f"Unknown format: {lines_format}")
+		return self.append(rows)
+
+	def select(self, question, state=None):
+		"""
+		Select the rows of a question, and optionally of a state, by comparing integer codes.
+		Not available in streaming mode.
+
+		Parameters:
+			question (str): The question to select.
+			state (str): The state to select, or None for all the states.
+
+		Returns:
+			pandas.DataFrame: The selected rows.
+		"""
+		# Missing values have the code -1, so unknown values map to -2 to match nothing
+		mask = self.data['Question'].cat.codes == self.codes['Question'].get(question, -2)
+		if state is not None:
+			mask &= self.data['LocationDesc'].cat.codes == \
+				self.codes['LocationDesc'].get(state, -2)
+		return self.data[mask]
+
+	def export_shared(self):
+		"""
+		Export the data to shared memory, for the worker processes to attach to it without
+		copying it.
+
+		Returns:
+			SharedDataset: The picklable handle of the shared data.
+		"""
+		# Imported here, shared_dataset depends on this module
+		from app.shared_dataset import SharedDataset
+
+		return SharedDataset.export(self)
+
+	def get_matrices(self):
+		"""
+		Get the state x question matrix of means and the (state, category, stratification) x
+		question matrix of means, built at once from the aggregates of every question. The
+		means that are missing or NaN are left out of both matrices.
+
+		Returns:
+			tuple: The two matrices, as pandas.DataFrame with one column per question.
+		"""
+		# Kept with the index they were built from: matrices built from the index an append
+		# replaced in the meantime are built again
+		matrices, index = self.matrices, self.index
+		if matrices is None or matrices[0] is not index:
+			states = pd.DataFrame({question: question_index.state_means()
+								   for question, question_index in index.items()})
+			categories = pd.DataFrame({question: {(state, *key): value
+												  for state in question_index.categories
+												  for key, value
+												  in question_index.category_means(state).items()}
+									   for question, question_index in index.items()})
+			matrices = (index, states.sort_index(), categories.sort_index())
+			self.matrices = matrices
+
+		return matrices[1:]
+
+	def get_index(self, question):
+		"""
+		Get the aggregate index of a question.
+
+		Parameters:
+			question (str): The question to look up.
+
+		Returns:
+			QuestionIndex: The aggregates of the question, empty if the question has no rows.
+		"""
+		return self.index.get(question, EMPTY_QUESTION_INDEX)
+
+def index_frame(data):
+	"""
+	Build the aggregate index of a DataFrame.
+
+	The sums are computed with the same pandas reductions the routes used to run per request
+	(Series.sum for the whole question, groupby sums for the breakdowns), so the means derived
+	from them are identical to the ones computed on the filtered data. The question and
+	question x state totals are also kept as correctly rounded sums (math.fsum) for the
+	endpoints that need extra precision.
+
+	Parameters:
+		data (pandas.DataFrame): The data to aggregate.
+
+	Returns:
+		dict: A dictionary mapping each question to its QuestionIndex.
+	"""
+	values = data.groupby('Question', observed=True)['Data_Value']
+	states = data.groupby(['Question', 'LocationDesc'], observed=True)['Data_Value'] \
+		.agg(['sum', 'count'])
+	categories = data.groupby(['Question', 'LocationDesc', 'StratificationCategory1',
+							   'Stratification1'], observed=True)['Data_Value'] \
+		.agg(['sum', 'count'])
+	exact_states = data.groupby(['Question', 'LocationDesc'], observed=True) \
+		['Data_Value'].agg(exact_sum)
+
+	index = {}
+	for question, question_values in values:
+		index[question] = QuestionIndex((question_values.sum(), question_values.count()),
+										exact_sum(question_values))
+
+	for (question, state), total, count in states.itertuples(name=None):
+		index[question].states[state] = (total, count)
+		index[question].exact_states[state] = exact_states[(question, state)]
+
+	for (question, state, category, stratification), total, count \
+			in categories.itertuples(name=None):
+		index[question].categories.setdefault(state, {})[(category, stratification)] = \
+			(total, count)
+
+	return index
+
+def merge_index(index, other):
+	"""
+	Fold the aggregate index of more rows into an index, in place. The sums are added, so the
+	means can differ from the ones of a single index in the last digits.
+
+	Parameters:
+		index (dict): The index to update.
+		other (dict): The index of the new rows.
+
+	Returns:
+		dict: The updated index.
+	"""
+	for question, other_index in other.items():
+		if question not in index:
+			index[question] = other_index
+			continue
+
+		question_index = index[question]
+		question_index.total = add(question_index.total, other_index.total)
+		question_index.exact_total = math.fsum([question_index.exact_total,
+												 other_index.exact_total])
+
+		for state, aggregate in other_index.states.items():
+			question_index.states[state] = add(question_index.states.get(state, (0.0, 0)),
+											   aggregate)
+			question_index.exact_states[state] = math.fsum(
+				[question_index.exact_states.get(state, 0.0), other_index.exact_states[state]])
+
+		for state, other_categories in other_index.categories.items():
+			categories = question_index.categories.setdefault(state, {})
+			for key, aggregate in other_categories.items():
+				categories[key] = add(categories.get(key, (0.0, 0)), aggregate)
+
+		# The derived orders are computed again from the new aggregates
+		question_index.sorted_means = None
+
+	return index
+
+def add(aggregate, other):
+	"""
+	Add two (sum, count) aggregates.
+
+	Parameters:
+		aggregate (tuple): The first sum and number of non-null values.
+		other (tuple): The second sum and number of non-null values.
+
+	Returns:
+		tuple: The sum and number of non-null values of both.
+	"""
+	return aggregate[0] + other[0], aggregate[1] + other[1]
+
+def exact_sum(values):
+	"""
+	Compute the correctly rounded sum of the non-null values, without the rounding errors
+	accumulated by a naive or pairwise summation.
+
+	Parameters:
+		values (pandas.Series): The values to add up.
+
+	Returns:
+		float: The sum of the values.
+	"""
+	return math.fsum(values.dropna())
+
+def mean(aggregate):
+	"""
+	Compute the mean from a (sum, count) aggregate.
+
+	Parameters:
+		aggregate (tuple): The sum and the number of non-null values.
+
+	Returns:
+		float: The mean, or NaN if there are no values.
+	"""
+	total, count = aggregate
+	if count == 0:
+		return float('nan')
+	return float(total) / float(count)
+
+class QuestionIndex:
+	"""
+	Class holding the precomputed (sum, count) aggregates of a single question.
+	"""
+	def __init__(self, total=(0.0, 0), exact_total=0.0):
+		"""
+		Initialize the QuestionIndex.
+
+		Parameters:
+			total (tuple): The sum and count of all the values of the question.
+			exact_total (float): The correctly rounded sum of all the values of the question.
+		"""
+		self.total = total
+		self.exact_total = exact_total
+		# {state: (sum, count)}
+		self.states = {}
+		# {state: correctly rounded sum}
+		self.exact_states = {}
+		# {state: {(category, stratification): (sum, count)}}
+		self.categories = {}
+		# (state, mean) pairs in ascending and descending order, sorted on the first request
+		self.sorted_means = None
+
+	def copy(self):
+		"""
+		Copy the aggregates, to update them without changing the ones read by running queries.
+
+		Returns:
+			QuestionIndex: The copy.
+		"""
+		question_index = QuestionIndex(self.total, self.exact_total)
+		question_index.states = dict(self.states)
+		question_index.exact_states = dict(self.exact_states)
+		question_index.categories = {state: dict(categories)
+									 for state, categories in self.categories.items()}
+		return question_index
+
+	def global_mean(self):
+		"""
+		Get the mean of all the values of the question.
+
+		Returns:
+			float: The global mean of the question.
+		"""
+		return mean(self.total)
+
+	def exact_global_mean(self):
+		"""
+		Get the mean of all the values of the question, computed from the correctly rounded sum.
+
+		Returns:
+			float: The global mean of the question.
+		"""
+		return mean((self.exact_total, self.total[1]))
+
+	def exact_state_mean(self, state):
+		"""
+		Get the mean of a state, computed from the correctly rounded sum.
+
+		Parameters:
+			state (str): The state to look up.
+
+		Returns:
+			float: The mean of the state, or NaN if the state has no values.
+		"""
+		if state not in self.states:
+			return float('nan')
+		return mean((self.exact_states[state], self.states[state][1]))
+
+	def state_means(self):
+		"""
+		Get the mean of each state, ordered by state name.
+
+		Returns:
+			dict: The mean for each state.
+		"""
+		return {state: mean(aggregate) for state, aggregate in self.states.items()}
+
+	def ranking(self):
+		"""
+		Get the state means sorted in ascending and in descending order. They are sorted once
+		and kept until the aggregates change, so the first or last k states are a slice.
+
+		Returns:
+			tuple: The ascending and the descending lists of (state, mean) pairs.
+		"""
+		if self.sorted_means is None:
+			state_means = pd.Series(self.state_means(), dtype='float64')
+			self.sorted_means = tuple(list(zip(means.index, means.tolist()))
+									  for means in (state_means.sort_values(),
+													state_means.sort_values(ascending=False)))
+
+		return self.sorted_means
+
+	def category_means(self, state):
+		"""
+		Get the mean of each (category, stratification) pair of a state.
+
+		Parameters:
+			state (str): The state to look up.
+
+		Returns:
+			dict: The mean for each (category, stratification) pair.
+		"""
+		return {key: mean(aggregate)
+				for key, aggregate in self.categories.get(state, {}).items()}
+
+EMPTY_QUESTION_INDEX = QuestionIndex()
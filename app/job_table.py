@@ -0,0 +1,181 @@
+import bisect
+import itertools
+import time
+from threading import Lock
+
+class JobTable:
+	"""
+	Class representing the table of job statuses, shared by the Flask request threads that
+	add and read jobs and the worker threads that complete them.
+
+	The statuses need no lock: the job IDs come from itertools.count, whose next() is atomic,
+	every update stores a new status dict under a single key and readers only get copies,
+	all of which are single atomic operations on the dict under the GIL. Only the sorted list
+	of job IDs used for the paginated listing is guarded by a lock.
+	"""
+	def __init__(self):
+		"""
+		Initialize an empty JobTable, the first job gets the ID 1.
+		"""
+		self.job_ids = itertools.count(1)
+		self.jobs = {}
+		self.created = {}
+		self.order = []
+		self.order_lock = Lock()
+
+	def add(self, status):
+		"""
+		Allocate a new job ID and add the job with the given status.
+
+		Parameters:
+			status (str): The initial status of the job.
+
+		Returns:
+			int: The ID of the new job.
+		"""
+		job_id = next(self.job_ids)
+		self.created[job_id] = time.monotonic()
+		self.jobs[str(job_id)] = {"status": status}
+
+		# The IDs are added almost in order, so the insertion is close to the end
+		with self.order_lock:
+			bisect.insort(self.order, job_id)
+
+		return job_id
+
+	def restore(self, job_id, status):
+		"""
+		Add a job under a given ID, for the jobs resumed from a previous start. The IDs
+		allocated afterwards follow it. Must be called before the table is shared.
+
+		Parameters:
+			job_id (int): The ID of the job.
+			status (str): The status of the job.
+
+		Returns:
+			None
+		"""
+		self.job_ids = itertools.count(max(job_id + 1, next(self.job_ids)))
+		self.created[job_id] = time.monotonic()
+		self.jobs[str(job_id)] = {"status": status}
+
+		with self.order_lock:
+			bisect.insort(self.order, job_id)
+
+	def set_status(self, job_id, status):
+		"""
+		Update the status of a job.
+
+		Parameters:
+			job_id (int): The ID of the job.
+			status (str): The new status of the job.
+
+		Returns:
+			None
+		"""
+		self.jobs[str(job_id)] = {"status": status}
+
+	def get(self, job_id):
+		"""
+		Get the status of a job.
+
+		Parameters:
+			job_id (str): The ID of the job.
+
+		Returns:
+			dict: The status of the job, or None if there is no such job.
+		"""
+		return self.jobs.get(job_id)
+
+	def remove(self, job_ids):
+		"""
+		Remove jobs from the table.
+
+		Parameters:
+			job_ids (list): The IDs of the jobs to remove.
+
+		Returns:
+			None
+		"""
+		for job_id in job_ids:
+			self.jobs.pop(str(job_id), None)
+			self.created.pop(job_id, None)
+
+		removed = set(job_ids)
+		with self.order_lock:
+			self.order = [job_id for job_id in self.order if job_id not in removed]
+
+	def expired(self, max_count, max_age):
+		"""
+		Get the finished jobs that are older than the maximum age, and the oldest finished jobs
+		above the maximum number of jobs. Running jobs are never expired.
+
+		Parameters:
+			max_count (int): The maximum number of jobs kept in the table.
+			max_age (float): The number of seconds a finished job is kept, 0 to keep it forever.
+
+		Returns:
+			list: The IDs of the expired jobs.
+		"""
+		now = time.monotonic()
+		with self.order_lock:
+			order = list(self.order)
+
+		excess = len(order) - max_count
+		expired = []
+		for job_id in order:
+			status = self.jobs.get(str(job_id))
+			if status is None or status["status"] == "running":
+				continue
+
+			too_old = max_age > 0 and now - self.created.get(job_id, now) > max_age
+			if too_old or excess > 0:
+				expired.append(job_id)
+				excess -= 1
+
+		return expired
+
+	def page(self, cursor, limit):
+		"""
+		Get the jobs following a cursor, in increasing order of their IDs.
+
+		Parameters:
+			cursor (int): The ID of the last job of the previous page, 0 for the first page.
+			limit (int): The maximum number of jobs returned.
+
+		Returns:
+			tuple: The status of every job of the page by job ID, and the cursor of the next page
+			or None if this is the last page.
+		"""
+		with self.order_lock:
+			start = bisect.bisect_right(self.order, cursor)
+			job_ids = self.order[start:start + limit]
+			last_page = start + limit >= len(self.order)
+
+		jobs = {}
+		for job_id in job_ids:
+			status = self.jobs.get(str(job_id))
+			if status is not None:
+				jobs[str(job_id)] = status
+
+		if last_page or not job_ids:
+			return jobs, None
+		return jobs, job_ids[-1]
+
+	def snapshot(self):
+		"""
+		Get a copy of the table that can be read while jobs keep being added and updated.
+
+		Returns:
+			dict: The status of every job, by job ID.
+		"""
+		return self.jobs.copy()
+
+	def __len__(self):
+		"""
+		Get the number of jobs in the table.
+
+		Returns:
+			int: The number of jobs.
+		"""
+		return len(self.jobs)
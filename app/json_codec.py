@@ -0,0 +1,45 @@
+import json
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+def dumps(obj):
+	"""
+	Encode an object to JSON bytes, with the same sorted keys and compact separators as
+	Flask's jsonify. orjson is used if installed, otherwise the standard json module. The
+	JSON is equivalent to jsonify's but not always byte-identical: orjson writes some floats
+	differently (1.5e-05 as 0.000015, 1e+16 as 1e16) and does not escape non-ASCII text.
+
+	Parameters:
+		obj (any): The object to encode.
+
+	Returns:
+		bytes: The encoded object.
+	"""
+	if orjson is not None:
+		encoded = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS | orjson.OPT_SERIALIZE_NUMPY)
+
+		# orjson writes NaN as null, jsonify writes NaN, so those results use the json module
+		if b'null' not in encoded:
+			return encoded
+
+	return json.dumps(obj, sort_keys=True, separators=(',', ':')).encode()
+
+def envelope(status, payload, job_id=None):
+	"""
+	Splice already encoded data into the {'data', 'status'} response envelope, without
+	decoding it. The keys are in the same sorted order as jsonify would write them.
+
+	Parameters:
+		status (str): The status of the job.
+		payload (bytes): The encoded data.
+		job_id (int): The ID of the job, added to the envelope if given.
+
+	Returns:
+		bytes: The encoded response body.
+	"""
+	if job_id is not None:
+		payload += b',"job_id":' + dumps(job_id)
+	return b'{"data":' + payload + b',"status":' + dumps(status) + b'}\n'
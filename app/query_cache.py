@@ -0,0 +1,121 @@
+import json
+import os
+from collections import OrderedDict
+from threading import Lock
+
+class QueryCache:
+	"""
+	Class representing a bounded LRU cache of query results, keyed by the query and its payload.
+	"""
+	def __init__(self, generation):
+		"""
+		Initialize the QueryCache with the size defined in the environment variable
+		QUERY_CACHE_SIZE. If the environment variable is not set use 256 entries, 0 disables
+		the cache.
+
+		Parameters:
+			generation (callable): Returns the version of the data the results are computed on.
+				The cache is emptied whenever it changes.
+		"""
+		if 'QUERY_CACHE_SIZE' in os.environ:
+			self.max_size = int(os.environ.get('QUERY_CACHE_SIZE'))
+		else:
+			self.max_size = 256
+
+		self.generation = generation
+		self.current_generation = None
+		self.entries = OrderedDict()
+		self.hits = 0
+		self.misses = 0
+		self.lock = Lock()
+
+	@staticmethod
+	def make_key(query, data):
+		"""
+		Build the cache key of a query.
+
+		Parameters:
+			query (callable): The function computing the result.
+			data (dict): The request payload.
+
+		Returns:
+			tuple: The name of the query and the normalized payload.
+		"""
+		return (query.__name__, json.dumps(data, sort_keys=True))
+
+	def check_generation(self):
+		"""
+		Empty the cache if the data changed since the entries were added. Must be called with
+		the lock held.
+
+		Returns:
+			any: The current version of the data.
+		"""
+		generation = self.generation()
+		if generation != self.current_generation:
+			self.entries.clear()
+			self.current_generation = generation
+		return generation
+
+	def get(self, key):
+		"""
+		Get the cached result of a query.
+
+		Parameters:
+			key (tuple): The cache key of the query.
+
+		Returns:
+			tuple: Whether the result was found, the result and the version of the data.
+		"""
+		with self.lock:
+			generation = self.check_generation()
+			if key in self.entries:
+				self.entries.move_to_end(key)
+				self.hits += 1
+				return True, self.entries[key], generation
+
+			self.misses += 1
+			return False, None, generation
+
+	def put(self, key, result, generation):
+		"""
+		Add the result of a query, evicting the least recently used entry if the cache is full.
+
+		Parameters:
+			key (tuple): The cache key of the query.
+			result (any): The result of the query.
+			generation (any): The version of the data the result was computed on.
+
+		Returns:
+			None
+		"""
+		if self.max_size <= 0:
+			return
+
+		with self.lock:
+			# Drop results computed on data that was replaced in the meantime
+			if self.check_generation() != generation:
+				return
+
+			self.entries[key] = result
+			self.entries.move_to_end(key)
+			if len(self.entries) > self.max_size:
+				self.entries.popitem(last=False)
+
+	def clear(self):
+		"""
+		Remove all the entries of the cache.
+		"""
+		with self.lock:
+			self.entries.clear()
+
+	def stats(self):
+		"""
+		Get the hit and miss counters of the cache.
+
+		Returns:
+			dict: The counters, the number of entries and the maximum size.
+		"""
+		with self.lock:
+			return {"hits": self.hits, "misses": self.misses,
+					"size": len(self.entries), "max_size": self.max_size}
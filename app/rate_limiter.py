@@ -0,0 +1,71 @@
+import os
+import time
+from collections import OrderedDict
+from threading import Lock
+
+class RateLimiter:
+	"""
+	Class representing a per-client token bucket: every client can send a burst of requests,
+	then the requests are admitted at a fixed rate.
+	"""
+	def __init__(self, rate, burst, max_clients=10000):
+		"""
+		Initialize the RateLimiter.
+
+		Parameters:
+			rate (float): The number of requests per second admitted for each client, 0 to admit
+				every request.
+			burst (int): The number of requests a client can send at once.
+			max_clients (int): The maximum number of clients tracked, the least recently seen
+				ones are forgotten first (their bucket is full again).
+		"""
+		self.rate = rate
+		self.burst = burst
+		self.max_clients = max_clients
+		# {client: (tokens, time of the last update)}
+		self.buckets = OrderedDict()
+		self.lock = Lock()
+
+	def acquire(self, client):
+		"""
+		Take a token from the bucket of a client.
+
+		Parameters:
+			client (str): The client sending the request.
+
+		Returns:
+			float: 0 if the request is admitted, otherwise the number of seconds until the
+			client gets a new token.
+		"""
+		if self.rate <= 0:
+			return 0.0
+
+		now = time.monotonic()
+		with self.lock:
+			tokens, last = self.buckets.pop(client, (self.burst, now))
+			tokens = min(self.burst, tokens + (now - last) * self.rate)
+
+			if tokens >= 1:
+				tokens -= 1
+				wait = 0.0
+			else:
+				wait = (1 - tokens) / self.rate
+
+			self.buckets[client] = (tokens, now)
+			if len(self.buckets) > self.max_clients:
+				self.buckets.popitem(last=False)
+
+			return wait
+
+def create_rate_limiter():
+	"""
+	Create the rate limiter configured by the environment variables:
+		RATE_LIMIT: the number of requests per second admitted for each client, 0 to disable
+			the limit (default 0).
+		RATE_LIMIT_BURST: the number of requests a client can send at once (default 20).
+
+	Returns:
+		RateLimiter: The rate limiter.
+	"""
+	return RateLimiter(float(os.environ.get('RATE_LIMIT', 0)),
+					   int(os.environ.get('RATE_LIMIT_BURST', 20)))
@@ -0,0 +1,299 @@
+import logging
+import os
+import time
+from collections import OrderedDict
+from queue import Queue
+from threading import Lock, Thread
+
+class MemoryResultStore:
+	"""
+	Class representing a bounded in-memory store of job results, with TTL eviction.
+	"""
+	def __init__(self, max_entries, ttl):
+		"""
+		Initialize the MemoryResultStore.
+
+		Parameters:
+			max_entries (int): The maximum number of results kept, the oldest are evicted first.
+			ttl (float): The number of seconds a result is kept, 0 to keep it until evicted.
+		"""
+		self.max_entries = max_entries
+		self.ttl = ttl
+		self.entries = OrderedDict()
+		self.lock = Lock()
+
+	def expired(self, timestamp, now):
+		"""
+		Check if a result added at the given time has expired.
+
+		Parameters:
+			timestamp (float): The time the result was added at.
+			now (float): The current time.
+
+		Returns:
+			bool: True if the result has expired.
+		"""
+		return self.ttl > 0 and now - timestamp > self.ttl
+
+	def evict(self, now):
+		"""
+		Remove the expired results and the oldest ones above the size bound. Must be called
+		with the lock held.
+
+		Parameters:
+			now (float): The current time.
+
+		Returns:
+			None
+		"""
+		# The results are kept in insertion order, so the expired ones are at the front
+		while self.entries:
+			job_id, (timestamp, _) = next(iter(self.entries.items()))
+			if len(self.entries) <= self.max_entries and not self.expired(timestamp, now):
+				break
+			del self.entries[job_id]
+
+	def put(self, job_id, result):
+		"""
+		Add the result of a job.
+
+		Parameters:
+			job_id (str): The ID of the job.
+			result (any): The result of the job.
+
+		Returns:
+			None
+		"""
+		now = time.monotonic()
+		with self.lock:
+			self.entries[job_id] = (now, result)
+			self.entries.move_to_end(job_id)
+			self.evict(now)
+
+	def get(self, job_id):
+		"""
+		Get the result of a job.
+
+		Parameters:
+			job_id (str): The ID of the job.
+
+		Returns:
+			any: The result of the job.
+
+		Raises:
+			KeyError: If the result is not in the store or has expired.
+		"""
+		with self.lock:
+			timestamp, result = self.entries[job_id]
+			if self.expired(timestamp, time.monotonic()):
+				del self.entries[job_id]
+				raise KeyError(job_id)
+			return result
+
+	def delete(self, job_id):
+		"""
+		Remove the result of a job, if present.
+
+		Parameters:
+			job_id (str): The ID of the job.
+
+		Returns:
+			None
+		"""
+		with self.lock:
+			self.entries.pop(job_id, None)
+
+	def flush(self):
+		"""
+		Nothing to flush, the results are never written anywhere else.
+		"""
+
+class DiskResultStore:
+	"""
+	Class representing a store of encoded job results saved as JSON files in a directory.
+	"""
+	def __init__(self, directory):
+		"""
+		Initialize the DiskResultStore.
+
+		Parameters:
+			directory (str): The directory the results/{job_id}.json files are written to.
+		"""
+		self.directory = directory
+
+	def path(self, job_id):
+		"""
+		Get the path of the file holding the result of a job.
+
+		Parameters:
+			job_id (str): The ID of the job.
+
+		Returns:
+			str: The path of the JSON file.
+		"""
+		return os.path.join(self.directory, f"{job_id}.json")
+
+	def put(self, job_id, result):
+		"""
+		Write the result of a job to its JSON file.
+
+		Parameters:
+			job_id (str): The ID of the job.
+			result (bytes): The result of the job, encoded as JSON.
+
+		Returns:
+			None
+		"""
+		try:
+			f = open(self.path(job_id), "wb")
+		except FileNotFoundError:
+			# The directory is created with the first result
+			os.makedirs(self.directory, exist_ok=True)
+			f = open(self.path(job_id), "wb")
+		with f:
+			f.write(result)
+
+	def get(self, job_id):
+		"""
+		Read the result of a job from its JSON file.
+
+		Parameters:
+			job_id (str): The ID of the job.
+
+		Returns:
+			bytes: The result of the job, encoded as JSON.
+
+		Raises:
+			KeyError: If there is no file for the job.
+		"""
+		try:
+			with open(self.path(job_id), "rb") as f:
+				return f.read()
+		except FileNotFoundError:
+			raise KeyError(job_id) from None
+
+	def delete(self, job_id):
+		"""
+		Remove the JSON file of a job, if present.
+
+		Parameters:
+			job_id (str): The ID of the job.
+
+		Returns:
+			None
+		"""
+		try:
+			os.remove(self.path(job_id))
+		except FileNotFoundError:
+			pass
+
+	def flush(self):
+		"""
+		Nothing to flush, the results are written synchronously.
+		"""
+
+class WriteBehindResultStore:
+	"""
+	Class representing an in-memory store whose results are also persisted to disk by a
+	background thread, outside of the request path.
+	"""
+	def __init__(self, memory, disk):
+		"""
+		Initialize the WriteBehindResultStore and start the writer thread.
+
+		Parameters:
+			memory (MemoryResultStore): The store serving the reads.
+			disk (DiskResultStore): The store the results are persisted to.
+		"""
+		self.memory = memory
+		self.disk = disk
+		self.pending = Queue()
+		self.writer = Thread(target=self.write_pending, daemon=True)
+		self.writer.start()
+
+	def write_pending(self):
+		"""
+		Write the queued results to disk and remove the deleted ones, in order, forever. A
+		failed write is logged and the next ones are still done.
+		"""
+		while True:
+			job_id, result, deleted = self.pending.get()
+			try:
+				if deleted:
+					self.disk.delete(job_id)
+				else:
+					self.disk.put(job_id, result)
+			except Exception as e:
+				logging.getLogger('webserver_logger').error(f"Failed to persist result {job_id}: {e}")
+			finally:
+				self.pending.task_done()
+
+	def put(self, job_id, result):
+		"""
+		Add the result of a job to memory and queue it to be written to disk.
+
+		Parameters:
+			job_id (str): The ID of the job.
+			result (any): The result of the job.
+
+		Returns:
+			None
+		"""
+		self.memory.put(job_id, result)
+		self.pending.put((job_id, result, False))
+
+	def get(self, job_id):
+		"""
+		Get the result of a job from memory, or from disk if it was evicted.
+
+		Parameters:
+			job_id (str): The ID of the job.
+
+		Returns:
+			any: The result of the job.
+
+		Raises:
+			KeyError: If the result is neither in memory nor on disk.
+		"""
+		try:
+			return self.memory.get(job_id)
+		except KeyError:
+			return self.disk.get(job_id)
+
+	def delete(self, job_id):
+		"""
+		Remove the result of a job from memory, and queue its removal from disk after the
+		write of the result if it is still queued.
+
+		Parameters:
+			job_id (str): The ID of the job.
+
+		Returns:
+			None
+		"""
+		self.memory.delete(job_id)
+		self.pending.put((job_id, None, True))
+
+	def flush(self):
+		"""
+		Wait until all the queued results are written to (or removed from) disk.
+		"""
+		self.pending.join()
+
+def create_result_store():
+	"""
+	Create the result store configured by the environment variables:
+		RESULT_STORE_SIZE: the maximum number of results kept in memory (default 10000).
+		RESULT_STORE_TTL: the number of seconds a result is kept in memory (default 3600).
+		RESULT_STORE_PERSIST: if set to 1, the results are also written to results/.
+
+	Returns:
+		The result store.
+	"""
+	memory = MemoryResultStore(int(os.environ.get('RESULT_STORE_SIZE', 10000)),
+							   float(os.environ.get('RESULT_STORE_TTL', 3600)))
+
+	if os.environ.get('RESULT_STORE_PERSIST') == '1':
+		return WriteBehindResultStore(memory, DiskResultStore('results'))
+
+	return memory
@@ -1,9 +1,22 @@
-import json
-from decimal import Decimal
+import math
+import os
 
 from flask import request, jsonify
 
 from app import webserver
+from app.data_ingestor import mean
+from app.json_codec import envelope
+from app.scheduler import PRIORITIES
+from app.task_runner import QueueFull, ShuttingDown
+
+# Maximum estimated cost of a query run synchronously with the 'sync=1' parameter
+SYNC_COST_THRESHOLD = int(os.environ.get('SYNC_COST_THRESHOLD', 100))
+# Seconds a queued job can run before it times out, 0 for no limit, and the limits of
+# specific endpoints, e.g. JOB_DEADLINES='states_mean=2,mean_by_category_all=10'
+JOB_DEADLINE = float(os.environ.get('JOB_DEADLINE', 0))
+JOB_DEADLINES = {name.strip(): float(seconds)
+				 for name, seconds in (item.split('=') for item in
+									   os.environ.get('JOB_DEADLINES', '').split(',') if item)}
 
 # Example endpoint definition
 @webserver.route('/api/post_endpoint', methods=['POST'])
@@ -63,7 +76,8 @@ def check_job_id(job_id, message_error, message_success):
 @webserver.route('/api/get_results/<job_id>', methods=['GET'])
 def get_response(job_id):
 	"""
-	Handle the GET request for the results of a job.
+	Handle the GET request for the results of a job. With the 'wait' query parameter, a
+	running job is waited for up to that many seconds before answering.
 
 	Parameters:
 		job_id (str): The job_id to get the results for.
@@ -74,39 +88,249 @@ def get_response(job_id):
 	status = webserver.tasks_runner.get_task_status(job_id)["status"]
 	data = None
 
+	wait = request.args.get('wait', 0, type=float)
+	if status == "running" and wait > 0:
+		webserver.tasks_runner.wait_for_task(job_id, wait)
+		status = webserver.tasks_runner.get_task_status(job_id)["status"]
+
 	check_job_id(job_id, f"Failed to get job_id {job_id}", f"Got job_id {job_id}")
 
 	if status == "not found":
 		return jsonify({"status": "error","reason": "Invalid job_id"})
 
 	if status == "done":
-		with open(f"results/{job_id}.json", "r") as f:
-			data = json.load(f)
+		try:
+			data = webserver.tasks_runner.get_result(job_id)
+		except KeyError:
+			return jsonify({"status": "error", "reason": "Result expired"})
+
+		if webserver.tasks_runner.evict_after_read:
+			webserver.tasks_runner.forget([int(job_id)])
+
+		check_job_id(job_id, f"Failed to get data from job_id {job_id}", \
+				  f"Got data from job_id {job_id}")
 
-	check_job_id(job_id, f"Failed to get data from job_id {job_id}", \
-			  f"Got data from job_id {job_id}")
+		# The result is already encoded, it is only spliced into the response
+		return webserver.response_class(envelope(status, data), mimetype='application/json')
 
 	return jsonify({'status': status,'data': data})
 
-def api_states_mean(data):
+def estimate_cost(query, data):
+	"""
+	Estimate the cost of a query as the number of aggregates it reads from the index.
+
+	Parameters:
+		query (callable): The function computing the result of the request.
+		data (dict): The data containing the question.
+
+	Returns:
+		int: The estimated cost of the query.
+	"""
+	question_index = webserver.data_ingestor.get_index(data['question'])
+
+	if query is api_mean_by_category:
+		return sum(len(categories) for categories in question_index.categories.values())
+
+	if query in (api_states_mean, api_best5, api_worst5, api_diff_from_mean):
+		return len(question_index.states)
+
+	return 1
+
+def client_id():
+	"""
+	Get the client that sent the request, told apart by its address, which it can not change
+	at will like a header, to get more turns of the fair queuing or a higher rate limit.
+
+	Returns:
+		str: The client.
+	"""
+	return request.remote_addr
+
+def too_many_requests(retry_after, reason):
+	"""
+	Build the response refusing a request until the client retries later.
+
+	Parameters:
+		retry_after (float): The number of seconds after which the client should try again.
+		reason (str): Why the request is refused.
+
+	Returns:
+		Response: The 429 response, with the Retry-After header.
+	"""
+	response = jsonify({"status": "error", "reason": reason})
+	response.status_code = 429
+	response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+	return response
+
+@webserver.before_request
+def limit_rate():
+	"""
+	Refuse the POST requests of a client that sends them faster than the rate limit.
+
+	Returns:
+		Response: The 429 response, or None to handle the request.
+	"""
+	if request.method != 'POST':
+		return None
+
+	client = client_id()
+	wait = webserver.rate_limiter.acquire(client)
+	if wait > 0:
+		webserver.logger.error(f"Rate limit exceeded by {client}")
+		return too_many_requests(wait, "Rate limit exceeded")
+
+	return None
+
+def deadline(query):
+	"""
+	Get the number of seconds a job of an endpoint can run, from JOB_DEADLINES or else
+	JOB_DEADLINE.
+
+	Parameters:
+		query (callable): The function computing the result of the request.
+
+	Returns:
+		float: The number of seconds, or None for no limit.
+	"""
+	seconds = JOB_DEADLINES.get(query.__name__.removeprefix('api_'), JOB_DEADLINE)
+	return seconds if seconds > 0 else None
+
+@webserver.errorhandler(ShuttingDown)
+def shutting_down(error):
+	"""
+	Refuse the jobs submitted once the server started draining.
+
+	Parameters:
+		error (ShuttingDown): The error raised by the thread pool.
+
+	Returns:
+		Response: The 503 response.
+	"""
+	webserver.logger.error(str(error))
+	return jsonify({"status": "error", "reason": "Server is shutting down"}), 503
+
+def queue_task(data, query, priority, client):
+	"""
+	Add a task to the job queue, unless the queue is full.
+
+	Parameters:
+		data (dict): The data of the request.
+		query (callable): The function computing the result of the request.
+		priority (str): The priority class of the task.
+		client (str): The client that sent the request.
+
+	Returns:
+		JSON: The job_id of the task, or the 429 response if the queue is full.
+	"""
+	try:
+		job_id = webserver.tasks_runner.add_task(data, query, priority, client, deadline(query))
+	except QueueFull as e:
+		webserver.logger.error(str(e))
+		return too_many_requests(e.retry_after, "Too many queued jobs")
+
+	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
+
+	return jsonify({"job_id" : job_id})
+
+def scheduling(data, default):
+	"""
+	Get the priority class and the client of a request, for the scheduler of the thread pool.
+	The priority can be given in the 'priority' field, which is removed from the data.
+
+	Parameters:
+		data (dict): The data of the request.
+		default (str): The priority class used if the request does not give one.
+
+	Returns:
+		tuple: The priority class, or None if the given one is invalid, and the client.
+	"""
+	priority = data.pop('priority', default)
+	if priority not in PRIORITIES:
+		priority = None
+
+	return priority, client_id()
+
+def cost_class(cost):
+	"""
+	Get the priority class of a query from its estimated cost: the single lookups are
+	interactive and the ones too expensive to run synchronously are bulk.
+
+	Parameters:
+		cost (int): The estimated cost of the query.
+
+	Returns:
+		str: The priority class.
+	"""
+	if cost <= 1:
+		return 'interactive'
+	if cost <= SYNC_COST_THRESHOLD:
+		return 'normal'
+	return 'bulk'
+
+def valid_k(data):
+	"""
+	Check the optional number of states 'k' of a best/worst request.
+
+	Parameters:
+		data (dict): The data of the request.
+
+	Returns:
+		bool: True if 'k' is missing or a positive integer.
+	"""
+	k = data.get('k', 5)
+	return isinstance(k, int) and not isinstance(k, bool) and k > 0
+
+def submit_query(query):
+	"""
+	Handle a POST request for a query: add it to the job queue or, with the 'sync=1' query
+	parameter and if its estimated cost is below SYNC_COST_THRESHOLD, run it right away.
+
+	Parameters:
+		query (callable): The function computing the result of the request.
+
+	Returns:
+		JSON: The job_id of the task, and its status and data if it was run synchronously.
+	"""
+	data = request.json
+
+	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
+
+	if data['question'] not in webserver.data_ingestor.questions:
+		webserver.logger.error(f"Invalid question {data['question']}")
+		return jsonify({"status": "error", "reason": "Invalid question"}), 400
+
+	if not valid_k(data):
+		webserver.logger.error(f"Invalid k {data['k']}")
+		return jsonify({"status": "error", "reason": "Invalid k"}), 400
+
+	cost = estimate_cost(query, data)
+	priority, client = scheduling(data, cost_class(cost))
+	if priority is None:
+		return jsonify({"status": "error", "reason": "Invalid priority"}), 400
+
+	if request.args.get('sync') == '1' and cost <= SYNC_COST_THRESHOLD:
+		job_id, result = webserver.tasks_runner.run_task(data, query)
+		webserver.logger.info(f"Job {job_id} executed synchronously")
+		return webserver.response_class(envelope("done", result, job_id),
+										mimetype='application/json')
+
+	return queue_task(data, query, priority, client)
+
+def api_states_mean(data, question_index=None):
 		"""
 		Calculate the mean of the data for each state for a given question.
 
 		Parameters:
 			data (dict): The data containing the question.
+			question_index (QuestionIndex): The aggregates of the question, looked up if not given.
 
 		Returns:
 			dict: The mean of the data for each state for the given question.
 		"""
-		data_frame = webserver.data_ingestor.data
-		filtered_data = data_frame[data_frame['Question'] == data['question']]
+		if question_index is None:
+			question_index = webserver.data_ingestor.get_index(data['question'])
 
-		state_question_means = filtered_data.groupby(['LocationDesc', 'Question']) \
-		['Data_Value'].mean().reset_index()
-
-		result = state_question_means.set_index('LocationDesc')['Data_Value'].to_dict()
-
-		return result
+		return question_index.state_means()
 
 @webserver.route('/api/states_mean', methods=['POST'])
 def states_mean_request():
@@ -116,35 +340,27 @@ def states_mean_request():
 	Returns:
 		JSON: The job_id of the task.
 	"""
-	data = request.json
-
-	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
+	return submit_query(api_states_mean)
 
-	if data['question'] in webserver.data_ingestor.questions:
-		job_id = webserver.tasks_runner.add_task(data, api_states_mean)
-
-	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
-
-	return jsonify({"job_id" : job_id})
-
-def api_state_mean(data):
+def api_state_mean(data, question_index=None):
 	"""
 	Calculate the mean of the data for a given state for a given question.
 
 	Parameters:
 		data (dict): The data containing the state and the question.
+		question_index (QuestionIndex): The aggregates of the question, looked up if not given.
 
 	Returns:
 		dict: The mean of the data for the given state for the given question.
 	"""
-	data_frame = webserver.data_ingestor.data
+	if question_index is None:
+		question_index = webserver.data_ingestor.get_index(data['question'])
+	state = data['state']
 
-	filtered_data = data_frame[(data_frame['LocationDesc'] == data['state'])
-							  & (data_frame['Question'] == data['question'])]
+	if state not in question_index.states:
+		return {}
 
-	result = filtered_data.groupby('LocationDesc')['Data_Value'].mean().to_dict()
-
-	return result
+	return {state: mean(question_index.states[state])}
 
 
 @webserver.route('/api/state_mean', methods=['POST'])
@@ -155,39 +371,28 @@ def state_mean_request():
 	Returns:
 		JSON: The job_id of the task.
 	"""
-	data = request.json
-
-	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
+	return submit_query(api_state_mean)
 
-	if data['question'] in webserver.data_ingestor.questions:
-		job_id = webserver.tasks_runner.add_task(data, api_state_mean)
-
-	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
-
-	return jsonify({"job_id" : job_id})
-
-def api_best5(data):
+def api_best5(data, question_index=None):
 	"""
-	Calculate the best 5 states for a given question by mean.
+	Calculate the best 5 states (or the best 'k' states, if given) for a given question by mean.
 
 	Parameters:
-		data (dict): The data containing the question.
+		data (dict): The data containing the question, and optionally the number of states 'k'.
+		question_index (QuestionIndex): The aggregates of the question, looked up if not given.
 
 	Returns:
-		dict: The best 5 states for the given question.
+		dict: The best states for the given question.
 	"""
-	data_frame = webserver.data_ingestor.data
-	filtered_data = data_frame[data_frame['Question'] == data['question']]
-
-	state_question_means = filtered_data.groupby(['LocationDesc', 'Question']) \
-		['Data_Value'].mean().reset_index()
+	if question_index is None:
+		question_index = webserver.data_ingestor.get_index(data['question'])
+	ascending, descending = question_index.ranking()
+	k = data.get('k', 5)
 
 	if data['question'] in webserver.data_ingestor.questions_best_is_min:
-		result = state_question_means.set_index('LocationDesc')['Data_Value'] \
-												.sort_values().head(5).to_dict()
+		result = dict(ascending[:k])
 	else:
-		result = state_question_means.set_index('LocationDesc')['Data_Value'] \
-									.sort_values(ascending=False).head(5).to_dict()
+		result = dict(descending[:k])
 
 	return result
 
@@ -199,40 +404,28 @@ def best5_request():
 	Returns:
 		JSON: The job_id of the task.
 	"""
-	data = request.json
-
-	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
+	return submit_query(api_best5)
 
-	if data['question'] in webserver.data_ingestor.questions:
-		job_id = webserver.tasks_runner.add_task(data, api_best5)
-
-	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
-
-	return jsonify({"job_id" : job_id})
-
-def api_worst5(data):
+def api_worst5(data, question_index=None):
 	"""
-	Calculate the worst 5 states for a given question by mean.
+	Calculate the worst 5 states (or the worst 'k' states, if given) for a given question by mean.
 
 	Parameters:
-		data (dict): The data containing the question.
+		data (dict): The data containing the question, and optionally the number of states 'k'.
+		question_index (QuestionIndex): The aggregates of the question, looked up if not given.
 
 	Returns:
-		dict: The worst 5 states for the given question.
+		dict: The worst states for the given question.
 	"""
-	data_frame = webserver.data_ingestor.data
-	filtered_data = data_frame[data_frame['Question'] == data['question']]
-
-	# Calculăm media pentru fiecare combinație de 'LocationDesc' și 'QuestionID'
-	state_question_means = filtered_data.groupby(['LocationDesc', 'Question']) \
-											['Data_Value'].mean().reset_index()
+	if question_index is None:
+		question_index = webserver.data_ingestor.get_index(data['question'])
+	ascending, descending = question_index.ranking()
+	k = data.get('k', 5)
 
 	if data['question'] in webserver.data_ingestor.questions_best_is_min:
-		result = state_question_means.set_index('LocationDesc')['Data_Value'] \
-											.sort_values().tail(5).to_dict()
+		result = dict(ascending[-k:])
 	else:
-		result = state_question_means.set_index('LocationDesc')['Data_Value'] \
-								.sort_values(ascending=False).tail(5).to_dict()
+		result = dict(descending[-k:])
 
 	return result
 
@@ -244,31 +437,22 @@ def worst5_request():
 	Returns:
 		JSON: The job_id of the task.
 	"""
-	data = request.json
-
-	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
+	return submit_query(api_worst5)
 
-	if data['question'] in webserver.data_ingestor.questions:
-		job_id = webserver.tasks_runner.add_task(data, api_worst5)
-
-	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
-
-	return jsonify({"job_id" : job_id})
-
-def api_global_mean(data):
+def api_global_mean(data, question_index=None):
 	"""
 	Calculate the global mean for a given question.
 
 	Parameters:
 		data (dict): The data containing the question.
+		question_index (QuestionIndex): The aggregates of the question, looked up if not given.
 
 	Returns:
 		dict: The global mean for the given question.
 	"""
-	data_frame = webserver.data_ingestor.data
-	filtered_data = data_frame[data_frame['Question'] == data['question']]
-	mean = filtered_data['Data_Value'].mean()
-	result = {"global_mean": mean}
+	if question_index is None:
+		question_index = webserver.data_ingestor.get_index(data['question'])
+	result = {"global_mean": question_index.global_mean()}
 	return result
 
 @webserver.route('/api/global_mean', methods=['POST'])
@@ -279,37 +463,28 @@ def global_mean_request():
 	Returns:
 		JSON: The job_id of the task.
 	"""
-	data = request.json
-
-	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
+	return submit_query(api_global_mean)
 
-	if data['question'] in webserver.data_ingestor.questions:
-		job_id = webserver.tasks_runner.add_task(data, api_global_mean)
-
-	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
 
-	return jsonify({"job_id" : job_id})
-
-
-def api_diff_from_mean(data):
+def api_diff_from_mean(data, question_index=None):
 	"""
 	Calculate the difference between the global mean and the mean for each state for a given
 	question.
 
 	Parameters:
 		data (dict): The data containing the question.
+		question_index (QuestionIndex): The aggregates of the question, looked up if not given.
 
 	Returns:
 		dict: The difference between the global mean and the mean for each state for the given
 		question.
 	"""
-	data_frame = webserver.data_ingestor.data
-	filtered_data = data_frame[data_frame['Question'] == data['question']]
-	global_mean = filtered_data['Data_Value'].mean()
-	state_means = filtered_data.groupby('LocationDesc')['Data_Value'].mean()
-	result = global_mean - state_means
+	if question_index is None:
+		question_index = webserver.data_ingestor.get_index(data['question'])
+	global_mean = question_index.global_mean()
 
-	return result.to_dict()
+	return {state: global_mean - state_mean
+			for state, state_mean in question_index.state_means().items()}
 
 @webserver.route('/api/diff_from_mean', methods=['POST'])
 def diff_from_mean_request():
@@ -320,41 +495,30 @@ def diff_from_mean_request():
 	Returns:
 		JSON: The job_id of the task.
 	"""
-	data = request.json
-
-	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
-
-	if data['question'] in webserver.data_ingestor.questions:
-		job_id = webserver.tasks_runner.add_task(data, api_diff_from_mean)
+	return submit_query(api_diff_from_mean)
 
-	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
-
-	return jsonify({"job_id" : job_id})
-
-def api_state_diff_from_mean(data):
+def api_state_diff_from_mean(data, question_index=None):
 	"""
 	Calculate the difference between the global mean and the mean for a given state for a given
 	question.
 
 	Parameters:
 		data (dict): The data containing the state and the question.
+		question_index (QuestionIndex): The aggregates of the question, looked up if not given.
 
 	Returns:
 		dict: The difference between the global mean and the mean for the given state for the given
 		question.
 	"""
-	data_frame = webserver.data_ingestor.data
-
-	# Convertim valorile din data_frame în Decimal pentru precizie mai mare
-	data_frame['Data_Value'] = data_frame['Data_Value'].apply(Decimal)
+	if question_index is None:
+		question_index = webserver.data_ingestor.get_index(data['question'])
 
-	# Calculăm media pentru statul dat și media globală
-	state_mean = data_frame[(data_frame['LocationDesc'] == data['state'])
-						   & (data_frame['Question'] == data['question'])]['Data_Value'].mean()
-	global_mean = data_frame[data_frame['Question'] == data['question']]['Data_Value'].mean()
+	# Folosim sumele rotunjite corect pentru precizie mai mare
+	state_mean = question_index.exact_state_mean(data['state'])
+	global_mean = question_index.exact_global_mean()
 
 	# Calculăm diferența dintre media globală și media statului
-	result = float(global_mean - state_mean)
+	result = global_mean - state_mean
 
 	# {"Virgin Islands": -5.858706315144083}
 	return {data['state']: result}
@@ -368,32 +532,26 @@ def state_diff_from_mean_request():
 	Returns:
 		JSON: The job_id of the task.
 	"""
-	data = request.json
-
-	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
-
-	if data['question'] in webserver.data_ingestor.questions:
-		job_id = webserver.tasks_runner.add_task(data, api_state_diff_from_mean)
-
-	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
-
-	return jsonify({"job_id" : job_id})
+	return submit_query(api_state_diff_from_mean)
 
-def api_mean_by_category(data):
+def api_mean_by_category(data, question_index=None):
 	"""
 	Calculate the mean of the data for each category for a given question.
 
 	Parameters:
 		data (dict): The data containing the question.
+		question_index (QuestionIndex): The aggregates of the question, looked up if not given.
 
 	Returns:
 		dict: The mean of the data for each category for the given question.
 	"""
-	data_frame = webserver.data_ingestor.data
-	filtered_data = data_frame[data_frame['Question'] == data['question']]
-	result = filtered_data.groupby(['LocationDesc', 'StratificationCategory1', \
-								 'Stratification1'])['Data_Value'].mean().to_dict()
-	return {str(key): value for key, value in result.items()}
+	if question_index is None:
+		question_index = webserver.data_ingestor.get_index(data['question'])
+	result = {}
+	for state in question_index.categories:
+		for (category, stratification), value in question_index.category_means(state).items():
+			result[str((state, category, stratification))] = value
+	return result
 
 @webserver.route('/api/mean_by_category', methods=['POST'])
 def mean_by_category_request():
@@ -403,32 +561,22 @@ def mean_by_category_request():
 	Returns:
 		JSON: The job_id of the task.
 	"""
-	data = request.json
-
-	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
-
-	if data['question'] in webserver.data_ingestor.questions:
-		job_id = webserver.tasks_runner.add_task(data, api_mean_by_category)
-
-	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
-
-	return jsonify({"job_id" : job_id})
+	return submit_query(api_mean_by_category)
 
-def api_state_mean_by_category(data):
+def api_state_mean_by_category(data, question_index=None):
 	"""
 	Calculate the mean of the data for each category for a given question for a given state.
 
 	Parameters:
 		data (dict): The data containing the state and the question.
+		question_index (QuestionIndex): The aggregates of the question, looked up if not given.
 
 	Returns:
 		dict: The mean of the data for each category for the given question for the given state.
 	"""
-	data_frame = webserver.data_ingestor.data
-	filtered_data = data_frame[(data_frame['LocationDesc'] == data['state']) & \
-							(data_frame['Question'] == data['question'])]
-	result = filtered_data.groupby(['StratificationCategory1', 'Stratification1']) \
-		['Data_Value'].mean().to_dict()
+	if question_index is None:
+		question_index = webserver.data_ingestor.get_index(data['question'])
+	result = question_index.category_means(data['state'])
 	return {data['state']: {str(key): value for key, value in result.items()}}
 
 @webserver.route('/api/state_mean_by_category', methods=['POST'])
@@ -440,29 +588,239 @@ def state_mean_by_category_request():
 	Returns:
 		JSON: The job_id of the task.
 	"""
+	return submit_query(api_state_mean_by_category)
+
+def api_states_mean_all(data):
+	"""
+	Calculate the mean of the data for each state for every question, from the state x
+	question matrix.
+
+	Parameters:
+		data (dict): Unused, the statistics are computed for all the questions.
+
+	Returns:
+		dict: The mean of the data for each state, by question.
+	"""
+	states, _ = webserver.data_ingestor.get_matrices()
+	return {question: column.dropna().to_dict() for question, column in states.items()}
+
+def api_global_mean_all(data):
+	"""
+	Calculate the global mean for every question.
+
+	Parameters:
+		data (dict): Unused, the statistics are computed for all the questions.
+
+	Returns:
+		dict: The global mean, by question.
+	"""
+	data_ingestor = webserver.data_ingestor
+	return {question: data_ingestor.get_index(question).global_mean()
+			for question in data_ingestor.index}
+
+def api_best5_all(data):
+	"""
+	Calculate the best 5 states for every question, each question being sorted only once.
+
+	Parameters:
+		data (dict): Unused, the statistics are computed for all the questions.
+
+	Returns:
+		dict: The best 5 states, by question.
+	"""
+	data_ingestor = webserver.data_ingestor
+	return {question: api_best5({'question': question}, data_ingestor.get_index(question))
+			for question in data_ingestor.index}
+
+def api_worst5_all(data):
+	"""
+	Calculate the worst 5 states for every question, each question being sorted only once.
+
+	Parameters:
+		data (dict): Unused, the statistics are computed for all the questions.
+
+	Returns:
+		dict: The worst 5 states, by question.
+	"""
+	data_ingestor = webserver.data_ingestor
+	return {question: api_worst5({'question': question}, data_ingestor.get_index(question))
+			for question in data_ingestor.index}
+
+def api_mean_by_category_all(data):
+	"""
+	Calculate the mean of the data for each category for every question, from the
+	(state, category, stratification) x question matrix.
+
+	Parameters:
+		data (dict): Unused, the statistics are computed for all the questions.
+
+	Returns:
+		dict: The mean of the data for each category, by question.
+	"""
+	_, categories = webserver.data_ingestor.get_matrices()
+	return {question: {str(key): value for key, value in column.dropna().items()}
+			for question, column in categories.items()}
+
+def submit_all_questions_query(query):
+	"""
+	Handle a POST request for a statistic of all the questions.
+
+	Parameters:
+		query (callable): The function computing the result of the request.
+
+	Returns:
+		JSON: The job_id of the task.
+	"""
+	data = request.get_json(silent=True) or {}
+
+	priority, client = scheduling(data, 'bulk')
+	if priority is None:
+		return jsonify({"status": "error", "reason": "Invalid priority"}), 400
+
+	return queue_task(data, query, priority, client)
+
+@webserver.route('/api/states_mean_all', methods=['POST'])
+def states_mean_all_request():
+	"""
+	Handle the POST request for the mean of the data for each state for every question.
+
+	Returns:
+		JSON: The job_id of the task.
+	"""
+	return submit_all_questions_query(api_states_mean_all)
+
+@webserver.route('/api/global_mean_all', methods=['POST'])
+def global_mean_all_request():
+	"""
+	Handle the POST request for the global mean of every question.
+
+	Returns:
+		JSON: The job_id of the task.
+	"""
+	return submit_all_questions_query(api_global_mean_all)
+
+@webserver.route('/api/best5_all', methods=['POST'])
+def best5_all_request():
+	"""
+	Handle the POST request for the best 5 states of every question.
+
+	Returns:
+		JSON: The job_id of the task.
+	"""
+	return submit_all_questions_query(api_best5_all)
+
+@webserver.route('/api/worst5_all', methods=['POST'])
+def worst5_all_request():
+	"""
+	Handle the POST request for the worst 5 states of every question.
+
+	Returns:
+		JSON: The job_id of the task.
+	"""
+	return submit_all_questions_query(api_worst5_all)
+
+@webserver.route('/api/mean_by_category_all', methods=['POST'])
+def mean_by_category_all_request():
+	"""
+	Handle the POST request for the mean of the data for each category for every question.
+
+	Returns:
+		JSON: The job_id of the task.
+	"""
+	return submit_all_questions_query(api_mean_by_category_all)
+
+# Query functions by endpoint name, for the batch requests
+QUERIES = {
+	'states_mean': api_states_mean,
+	'state_mean': api_state_mean,
+	'best5': api_best5,
+	'worst5': api_worst5,
+	'global_mean': api_global_mean,
+	'diff_from_mean': api_diff_from_mean,
+	'state_diff_from_mean': api_state_diff_from_mean,
+	'mean_by_category': api_mean_by_category,
+	'state_mean_by_category': api_state_mean_by_category,
+}
+
+def api_batch(data):
+	"""
+	Evaluate a batch of requests. The requests are grouped by question, so the aggregates of
+	each question are looked up once and shared by all the requests about it.
+
+	Parameters:
+		data (dict): The data containing the list of requests, each one with the name of its
+		endpoint and the data the endpoint takes.
+
+	Returns:
+		list: The result of each request, in the order of the requests.
+	"""
+	data_ingestor = webserver.data_ingestor
+	requests = data['requests']
+
+	positions_by_question = {}
+	for position, item in enumerate(requests):
+		positions_by_question.setdefault(item['question'], []).append(position)
+
+	results = [None] * len(requests)
+	for question, positions in positions_by_question.items():
+		question_index = data_ingestor.get_index(question)
+		for position in positions:
+			item = requests[position]
+			results[position] = QUERIES[item['endpoint']](item, question_index)
+
+	return results
+
+@webserver.route('/api/batch', methods=['POST'])
+def batch_request():
+	"""
+	Handle the POST request for a batch of requests, given as
+	{"requests": [{"endpoint": "states_mean", "question": ...}, ...]}.
+
+	Returns:
+		JSON: The job_id of the task computing the list of results.
+	"""
 	data = request.json
 
-	check_data_for_logging(data, "Failed to get request", f"Got request {data}")
+	check_data_for_logging(data, "Failed to get request", f"Got batch request {data}")
 
-	if data['question'] in webserver.data_ingestor.questions:
-		job_id = webserver.tasks_runner.add_task(data, api_state_mean_by_category)
+	for item in data['requests']:
+		if item.get('endpoint') not in QUERIES:
+			webserver.logger.error(f"Invalid endpoint in batch {item.get('endpoint')}")
+			return jsonify({"status": "error", "reason": "Invalid endpoint"}), 400
 
-	check_job_id(job_id, "Failed to add job to the queue", f"Job {job_id} added to the queue")
+		if item.get('question') not in webserver.data_ingestor.questions:
+			webserver.logger.error(f"Invalid question in batch {item.get('question')}")
+			return jsonify({"status": "error", "reason": "Invalid question"}), 400
 
-	return jsonify({"job_id" : job_id})
+		if not valid_k(item):
+			webserver.logger.error(f"Invalid k in batch {item['k']}")
+			return jsonify({"status": "error", "reason": "Invalid k"}), 400
+
+	priority, client = scheduling(data, 'bulk')
+	if priority is None:
+		return jsonify({"status": "error", "reason": "Invalid priority"}), 400
+
+	return queue_task(data, api_batch, priority, client)
+
+# The queries the jobs saved by a drain can run when they are resumed, by function name
+RESUMABLE_QUERIES = {query.__name__: query for query in
+					 [*QUERIES.values(), api_batch, api_states_mean_all, api_global_mean_all,
+					  api_best5_all, api_worst5_all, api_mean_by_category_all]}
 
 @webserver.route('/api/graceful_shutdown', methods=['GET'])
 def graceful_shutdown():
 	"""
-	Handle the GET request to shut down the server gracefully.
+	Handle the GET request to shut down the server gracefully. The new jobs are refused with
+	a 503 while the queued and running ones are drained, see ThreadPool.graceful_shutdown.
 
 	Returns:
-		JSON: A message indicating whether the server is shutting down gracefully.
+		JSON: A message indicating whether the server is shutting down gracefully, and how
+		many jobs were drained, abandoned, cancelled and saved to be resumed.
 	"""
-	successful = webserver.tasks_runner.graceful_shutdown()
-	if successful:
-		webserver.logger.info("Shutting down the server gracefully")
-		return jsonify({"message": "Shutting down the server gracefully"})
+	report = webserver.tasks_runner.graceful_shutdown()
+	if report is not None:
+		webserver.logger.info(f"Shutting down the server gracefully {report}")
+		return jsonify(dict(report, message="Shutting down the server gracefully"))
 
 	webserver.logger.error("Failed to shut down the server gracefully")
 	return jsonify({"error": "Failed to shut down the server gracefully"}), 500
@@ -470,13 +828,65 @@ def graceful_shutdown():
 @webserver.route('/api/jobs', methods=['GET'])
 def get_jobs():
 	"""
-	Handle the GET request to get the jobs.
+	Handle the GET request to get the jobs. With the 'cursor' and 'limit' query parameters
+	only a page of jobs is returned, along with the cursor of the next page.
 
 	Returns:
 		JSON: The data containing the jobs.
 	"""
 	webserver.logger.info("Received request for jobs")
-	return jsonify(webserver.tasks_runner.data)
+
+	if 'cursor' in request.args or 'limit' in request.args:
+		cursor = request.args.get('cursor', 0, type=int)
+		limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+		jobs, next_cursor = webserver.tasks_runner.jobs.page(cursor, limit)
+		return jsonify({"jobs": jobs, "next_cursor": next_cursor})
+
+	return jsonify(webserver.tasks_runner.jobs.snapshot())
+
+@webserver.route('/api/jobs/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+	"""
+	Handle the DELETE request to cancel a job: a queued job is removed from the queue and
+	becomes "cancelled", a running job becomes "abandoned" and its result is dropped.
+
+	Parameters:
+		job_id (str): The ID of the job.
+
+	Returns:
+		JSON: The status of the job.
+	"""
+	webserver.logger.info(f"Received request to cancel job {job_id}")
+
+	status = webserver.tasks_runner.cancel(job_id)
+	if status["status"] == "not found":
+		webserver.logger.error(f"Invalid job_id {job_id}")
+		return jsonify({"status": "error", "reason": "Invalid job_id"}), 404
+
+	return jsonify(status)
+
+@webserver.route('/api/cache_stats', methods=['GET'])
+def get_cache_stats():
+	"""
+	Handle the GET request to get the hit and miss counters of the query cache.
+
+	Returns:
+		JSON: The counters and the size of the cache.
+	"""
+	webserver.logger.info("Received request for cache stats")
+	return jsonify(webserver.query_cache.stats())
+
+@webserver.route('/api/scheduler_stats', methods=['GET'])
+def get_scheduler_stats():
+	"""
+	Handle the GET request to get the queue depth and the wait times of every priority class
+	of the scheduler.
+
+	Returns:
+		JSON: The statistics of every priority class and the number of running jobs.
+	"""
+	webserver.logger.info("Received request for scheduler stats")
+	return jsonify(webserver.tasks_runner.scheduler_stats())
 
 @webserver.route('/api/num_jobs', methods=['GET'])
 def get_num_jobs():
@@ -487,7 +897,94 @@ def get_num_jobs():
 		JSON: The number of jobs.
 	"""
 	webserver.logger.info("Received request for number of jobs")
-	return jsonify({"num_jobs": len(webserver.tasks_runner.data)})
+	return jsonify({"num_jobs": len(webserver.tasks_runner.jobs)})
+
+@webserver.route('/api/ready', methods=['GET'])
+def get_ready():
+	"""
+	Handle the GET request to check if the dataset and its index are loaded, without waiting
+	for them.
+
+	Returns:
+		JSON: The readiness of the server, with the status code 503 while it is not ready.
+	"""
+	if webserver.ready.is_set():
+		return jsonify({"status": "ready", "version": webserver.dataset.version})
+
+	if webserver.load_error is not None:
+		return jsonify({"status": "error", "reason": str(webserver.load_error)}), 503
+
+	return jsonify({"status": "loading"}), 503
+
+@webserver.route('/api/admin/reload', methods=['POST'])
+def reload_dataset():
+	"""
+	Handle the POST request to load the CSV file again, for example once a new export replaced
+	it. The new dataset is loaded in the background and swapped in once it is indexed.
+
+	Returns:
+		JSON: The status of the reload, with the status code 409 if one is already running.
+	"""
+	webserver.logger.info("Received request to reload the dataset")
+
+	if not webserver.reload():
+		return jsonify({"status": "error", "reason": "Reload already in progress"}), 409
+
+	return jsonify({"status": "reloading"}), 202
+
+# Formats of the rows accepted by /api/admin/append, by content type
+APPEND_FORMATS = {
+	'text/csv': 'csv',
+	'application/x-ndjson': 'jsonl',
+	'application/jsonl': 'jsonl',
+}
+
+@webserver.route('/api/admin/append', methods=['POST'])
+def append_rows():
+	"""
+	Handle the POST request to append new rows to the dataset, sent as CSV with a header line
+	(text/csv) or as JSON lines (application/x-ndjson). The new rows are only kept in memory,
+	a reload reads the CSV file again.
+
+	Returns:
+		JSON: The number of appended rows and the new version of the dataset.
+	"""
+	lines_format = APPEND_FORMATS.get(request.mimetype)
+	if lines_format is None:
+		return jsonify({"status": "error", "reason": "Unsupported content type"}), 400
+
+	data_ingestor = webserver.data_ingestor
+	text = request.get_data(as_text=True)
+	try:
+		# The worker processes hold the previous rows, they are detached before the append
+		count = webserver.tasks_runner.refresh_dataset(
+			lambda: data_ingestor.append_text(text, lines_format))
+	except ValueError as e:
+		webserver.logger.error(f"Failed to append rows: {e}")
+		return jsonify({"status": "error", "reason": str(e)}), 400
+
+	webserver.logger.info(f"Appended {count} rows")
+
+	return jsonify({"status": "done", "rows": count, "version": data_ingestor.version})
+
+@webserver.route('/api/admin/reload', methods=['GET'])
+def get_reload_status():
+	"""
+	Handle the GET request to get the status of the last reload of the dataset.
+
+	Returns:
+		JSON: The status of the reload and the version of the dataset in use.
+	"""
+	version = webserver.dataset.version if webserver.ready.is_set() else None
+
+	if webserver.reloading.is_set():
+		return jsonify({"status": "reloading", "version": version})
+
+	if webserver.reload_error is not None:
+		return jsonify({"status": "error", "reason": str(webserver.reload_error),
+						"version": version})
+
+	return jsonify({"status": "done", "version": version})
 
 # You can check localhost in your browser to see what this displays
 @webserver.route('/')
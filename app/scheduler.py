@@ -0,0 +1,136 @@
+import time
+from collections import OrderedDict, deque
+
+# Priority classes, from the most to the least urgent
+PRIORITIES = ['interactive', 'normal', 'bulk']
+
+class Scheduler:
+	"""
+	Class representing the queue of the jobs waiting for a free worker. The jobs of a higher
+	priority class always go first, and within a class the clients are served in turn, one job
+	each, so a client with many queued jobs does not delay the others.
+	"""
+	def __init__(self, priorities=None):
+		"""
+		Initialize the Scheduler.
+
+		Parameters:
+			priorities (list): The priority classes, from the most to the least urgent.
+		"""
+		self.priorities = priorities if priorities is not None else PRIORITIES
+		# {priority: {client: deque of (enqueue time, item)}}, the next client to serve first
+		self.queues = {priority: OrderedDict() for priority in self.priorities}
+		self.depths = {priority: 0 for priority in self.priorities}
+		self.dispatched = {priority: 0 for priority in self.priorities}
+		self.total_wait = {priority: 0.0 for priority in self.priorities}
+		self.max_wait = {priority: 0.0 for priority in self.priorities}
+
+	def push(self, priority, client, item):
+		"""
+		Queue an item. Must be called with the lock of the owner held.
+
+		Parameters:
+			priority (str): The priority class of the item.
+			client (str): The client the item belongs to.
+			item (any): The item.
+
+		Returns:
+			None
+		"""
+		clients = self.queues[priority]
+		if client not in clients:
+			clients[client] = deque()
+		clients[client].append((time.monotonic(), item))
+		self.depths[priority] += 1
+
+	def pop(self):
+		"""
+		Remove the next item to run. Must be called with the lock of the owner held.
+
+		Returns:
+			any: The item, or None if the queue is empty.
+		"""
+		for priority in self.priorities:
+			clients = self.queues[priority]
+			if not clients:
+				continue
+
+			client, items = next(iter(clients.items()))
+			enqueued, item = items.popleft()
+			if items:
+				# The client goes after the others waiting in the same class
+				clients.move_to_end(client)
+			else:
+				del clients[client]
+
+			wait = time.monotonic() - enqueued
+			self.depths[priority] -= 1
+			self.dispatched[priority] += 1
+			self.total_wait[priority] += wait
+			self.max_wait[priority] = max(self.max_wait[priority], wait)
+			return item
+
+		return None
+
+	def remove(self, item):
+		"""
+		Remove a queued item before it runs. Must be called with the lock of the owner held.
+
+		Parameters:
+			item (any): The item.
+
+		Returns:
+			bool: False if the item is not queued.
+		"""
+		for priority in self.priorities:
+			clients = self.queues[priority]
+			for client, items in clients.items():
+				for entry in items:
+					if entry[1] is item:
+						items.remove(entry)
+						if not items:
+							del clients[client]
+						self.depths[priority] -= 1
+						return True
+
+		return False
+
+	def pop_all(self):
+		"""
+		Remove all the queued items, in the order they would run. Must be called with the lock
+		of the owner held.
+
+		Returns:
+			list: The priority class, the client and the item of every queued item.
+		"""
+		items = []
+		for priority in self.priorities:
+			for client, queue in self.queues[priority].items():
+				items.extend((priority, client, item) for _, item in queue)
+			self.queues[priority].clear()
+			self.depths[priority] = 0
+
+		return items
+
+	def __len__(self):
+		"""
+		Get the number of queued items.
+		"""
+		return sum(self.depths.values())
+
+	def stats(self):
+		"""
+		Get the queue depth and the wait times of every priority class. Must be called with the
+		lock of the owner held.
+
+		Returns:
+			dict: The number of queued and dispatched items, and the mean and maximum number of
+			seconds the dispatched items waited, by priority class.
+		"""
+		return {priority: {"queued": self.depths[priority],
+						   "clients": len(self.queues[priority]),
+						   "dispatched": self.dispatched[priority],
+						   "mean_wait": self.total_wait[priority] / self.dispatched[priority]
+										if self.dispatched[priority] else 0.0,
+						   "max_wait": self.max_wait[priority]}
+				for priority in self.priorities}
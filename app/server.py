@@ -0,0 +1,115 @@
+from threading import Event, Lock, Thread
+
+from flask import Flask
+
+from app.data_ingestor import DataIngestor
+
+class Webserver(Flask):
+	"""
+	Flask application whose dataset is loaded on first use instead of at import time, either
+	by the first request that needs it or by a background thread started with preload(). The
+	dataset can then be replaced without restarting the server with reload().
+	"""
+	def __init__(self, import_name, csv_path):
+		"""
+		Initialize the Webserver without loading the dataset.
+
+		Parameters:
+			import_name (str): The name of the application package.
+			csv_path (str): The path to the CSV file containing the data.
+		"""
+		super().__init__(import_name)
+		self.csv_path = csv_path
+		self.dataset = None
+		# Set once the dataset and its index are loaded
+		self.ready = Event()
+		self.load_error = None
+		self.load_lock = Lock()
+		# Set while a new dataset is loaded by reload()
+		self.reloading = Event()
+		self.reload_error = None
+
+	@property
+	def data_ingestor(self):
+		"""
+		The loaded dataset. If it is not loaded yet, the caller loads it, or waits for the
+		thread already loading it.
+		"""
+		if not self.ready.is_set():
+			self.load_dataset()
+		return self.dataset
+
+	@data_ingestor.setter
+	def data_ingestor(self, data_ingestor):
+		with self.load_lock:
+			self.dataset = data_ingestor
+			self.ready.set()
+
+	def load_dataset(self):
+		"""
+		Load the dataset and build its index, once.
+
+		Returns:
+			None
+		"""
+		with self.load_lock:
+			if self.ready.is_set():
+				return
+			try:
+				self.dataset = DataIngestor(self.csv_path)
+			except Exception as e:
+				self.load_error = e
+				raise
+			self.load_error = None
+			self.ready.set()
+
+	def preload(self):
+		"""
+		Start loading the dataset in a background thread, the requests arriving in the meantime
+		wait for it.
+
+		Returns:
+			None
+		"""
+		def load():
+			try:
+				self.load_dataset()
+			except Exception:
+				# Kept in load_error and reported by /api/ready, the next request retries
+				pass
+
+		Thread(target=load, daemon=True).start()
+
+	def reload(self):
+		"""
+		Load the CSV file again in a background thread and swap it in once it is indexed. The
+		running jobs finish on the dataset they started with and the new jobs use the new one,
+		the query cache is emptied by the change of version.
+
+		Returns:
+			bool: False if a reload is already in progress.
+		"""
+		with self.load_lock:
+			if self.reloading.is_set():
+				return False
+			self.reloading.set()
+
+		def load():
+			try:
+				data_ingestor = DataIngestor(self.csv_path)
+
+				def swap():
+					self.data_ingestor = data_ingestor
+
+				# The worker processes holding the previous dataset are detached before the swap
+				self.tasks_runner.refresh_dataset(swap)
+				self.reload_error = None
+				# Dropped on the next lookup anyway, as their version is stale, but freed now
+				self.query_cache.clear()
+			except Exception as e:
+				self.reload_error = e
+			finally:
+				self.reloading.clear()
+
+		Thread(target=load, daemon=True).start()
+		return True
@@ -0,0 +1,129 @@
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+import pandas as pd
+
+from app.data_ingestor import DataIngestor, DIMENSIONS
+
+def attach_block(name):
+	"""
+	Attach to an existing shared memory block without taking ownership of it, so the block
+	is not removed when the attaching process exits.
+
+	Parameters:
+		name (str): The name of the block.
+
+	Returns:
+		SharedMemory: The attached block.
+	"""
+	try:
+		return SharedMemory(name=name, track=False)
+	except TypeError:
+		# Before Python 3.13 the block is registered again with the resource tracker, which the
+		# spawned workers share with the exporting process, so this does not change its owner
+		return SharedMemory(name=name)
+
+class SharedDataset:
+	"""
+	Class representing a dataset exported to shared memory: the numeric columns and the codes
+	of the categorical columns each live in a shared block, while the categories (the question
+	and state names) and the aggregate index are small and sent once with the handle.
+	"""
+	def __init__(self, csv_path, columns, categories, index, chunk_size=0):
+		"""
+		Initialize the SharedDataset handle.
+
+		Parameters:
+			csv_path (str): The path to the CSV file the data was loaded from.
+			columns (dict): The (block name, dtype, length) of every column, by column name.
+			categories (dict): The categories of every categorical column.
+			index (dict): The aggregate index of the data.
+			chunk_size (int): The chunk size of a DataIngestor in streaming mode, which only
+				shares its index.
+		"""
+		self.csv_path = csv_path
+		self.columns = columns
+		self.categories = categories
+		self.index = index
+		self.chunk_size = chunk_size
+		# Kept only by the exporting process, which owns the blocks
+		self.blocks = []
+
+	@classmethod
+	def export(cls, data_ingestor):
+		"""
+		Copy the columns of a DataIngestor to new shared memory blocks.
+
+		Parameters:
+			data_ingestor (DataIngestor): The data to export.
+
+		Returns:
+			SharedDataset: The handle of the shared data.
+		"""
+		columns = {}
+		categories = {}
+		blocks = []
+		if data_ingestor.data is None:
+			return cls(data_ingestor.csv_path, columns, categories, data_ingestor.index,
+					   data_ingestor.chunk_size)
+
+		for column in data_ingestor.data.columns:
+			values = data_ingestor.data[column]
+			if column in DIMENSIONS:
+				categories[column] = list(values.cat.categories)
+				array = np.asarray(values.array.codes)
+			else:
+				array = values.to_numpy()
+
+			block = SharedMemory(create=True, size=max(array.nbytes, 1))
+			np.ndarray(array.shape, dtype=array.dtype, buffer=block.buf)[:] = array
+			blocks.append(block)
+			columns[column] = (block.name, array.dtype.str, len(array))
+
+		shared = cls(data_ingestor.csv_path, columns, categories, data_ingestor.index)
+		shared.blocks = blocks
+		return shared
+
+	def attach(self):
+		"""
+		Build a DataIngestor whose columns are views of the shared blocks.
+
+		Returns:
+			DataIngestor: The data, without any copy of the columns.
+		"""
+		if self.chunk_size:
+			return DataIngestor(self.csv_path, None, self.index, self.chunk_size)
+
+		blocks = []
+		columns = {}
+		for column, (name, dtype, length) in self.columns.items():
+			block = attach_block(name)
+			blocks.append(block)
+			array = np.ndarray((length,), dtype=np.dtype(dtype), buffer=block.buf)
+			if column in self.categories:
+				columns[column] = pd.Categorical.from_codes(array, self.categories[column],
+															validate=False)
+			else:
+				columns[column] = array
+
+		data_ingestor = DataIngestor(self.csv_path, pd.DataFrame(columns, copy=False), self.index)
+		# The views are only valid while the blocks are open
+		data_ingestor.shared_blocks = blocks
+		return data_ingestor
+
+	def close(self):
+		"""
+		Release the shared blocks, called by the exporting process once no worker uses them.
+		"""
+		for block in self.blocks:
+			block.close()
+			block.unlink()
+		self.blocks = []
+
+	def __getstate__(self):
+		"""
+		Pickle the handle without the blocks, which only belong to the exporting process.
+		"""
+		state = self.__dict__.copy()
+		state['blocks'] = []
+		return state
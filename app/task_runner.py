@@ -1,68 +1,634 @@
 import json
+import math
+import multiprocessing
 import os
-from threading import Thread
-from concurrent.futures import ThreadPoolExecutor
+import signal
+import time
+from threading import BoundedSemaphore, Condition, Event, RLock, Thread, Timer
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures.process import BrokenProcessPool
+
+from app.job_table import JobTable
+from app.json_codec import dumps
+from app.query_cache import QueryCache
+from app.result_store import create_result_store
+from app.scheduler import Scheduler
+
+# The queue a worker process reports the tasks it starts to, set by init_worker
+task_starts = None
+
+class QueueFull(Exception):
+	"""
+	Raised when a task is refused because too many tasks are already waiting.
+	"""
+	def __init__(self, retry_after):
+		"""
+		Initialize the QueueFull error.
+
+		Parameters:
+			retry_after (int): The number of seconds after which the client should try again.
+		"""
+		super().__init__(f"Too many queued tasks, retry after {retry_after} seconds")
+		self.retry_after = retry_after
+
+class ShuttingDown(RuntimeError):
+	"""
+	Raised when a task is submitted after the pool started draining.
+	"""
+	def __init__(self):
+		"""
+		Initialize the ShuttingDown error.
+		"""
+		super().__init__('cannot schedule new futures after shutdown')
 
 class ThreadPool:
 	"""
 	Class representing a thread pool for executing tasks asynchronously.
 	"""
-	def __init__(self):
+	def __init__(self, cache=None, results=None, csv_path=None, dataset=None):
 		"""
 		Initialize the ThreadPool with the number of threads defined in the environment variable TP_NUM_OF_THREADS.
 		If the environment variable is not set use the number of threads your hardware concurrency allows.
+
+		If the environment variable TP_EXECUTOR is set to 'process', the queries run in that many
+		worker processes instead of threads, started with the first task. The dataset is
+		exported to shared memory once and every worker attaches to it when it starts, instead
+		of loading its own copy.
+
+		The retention of the finished jobs is configured by the environment variables:
+			JOB_MAX_COUNT: the maximum number of jobs kept (default 10000).
+			JOB_MAX_AGE: the number of seconds a finished job is kept, 0 for no limit (default 3600).
+			JOB_EVICT_AFTER_READ: if set to 1, a job is removed once its result is read.
+			JOB_COMPACT_INTERVAL: the number of seconds between two compactions (default 10).
+
+		A task identical to one already queued or running, on the same data, is not run again:
+		it gets its own job ID and the result of the first one.
+
+		At most that many tasks are given to the executor at once, the others wait in a
+		Scheduler, by priority class and in turn by client. At most JOB_QUEUE_MAX_DEPTH tasks
+		wait at once (default 1000, 0 for no limit), the next ones are refused with QueueFull.
+
+		The clients waiting for a result are limited by the environment variables:
+			RESULTS_MAX_WAITERS: the maximum number of requests blocked at once (default 32).
+			RESULTS_MAX_WAIT: the maximum number of seconds a request is blocked (default 30).
+
+		The drain of graceful_shutdown is configured by the environment variables:
+			JOB_DRAIN_TIMEOUT: the number of seconds the running tasks are waited for (default 30).
+			JOB_QUEUE_FILE: if set, the file the queued tasks are saved to instead of being run,
+				and which resume() queues again on the next start.
+
+		Parameters:
+			cache (QueryCache): The cache of query results, or None to always execute the queries.
+			results: The store the job results are saved to, by default the one configured by
+				the environment (see create_result_store).
+			csv_path (str): The dataset loaded by the worker processes of the process backend.
+			dataset (callable): Returns the loaded dataset shared with the worker processes, or
+				None for each worker to load csv_path.
 		"""
 		if 'TP_NUM_OF_THREADS' in os.environ:
 			self.num_threads = int(os.environ.get('TP_NUM_OF_THREADS'))
 		else:
 			self.num_threads = os.cpu_count()
 
-		self.thread_pool = ThreadPoolExecutor(max_workers=self.num_threads)
-		self.job_counter = 1
-		self.data = {}
+		self.executor_type = os.environ.get('TP_EXECUTOR', 'thread')
+		self.csv_path = csv_path
+		self.dataset = dataset
+		self.shared = None
+		# The queue the worker processes report the tasks they start to, created with them
+		self.starts = None
+		self.executor_lock = RLock()
+		if self.executor_type == 'process':
+			self.thread_pool = None
+		else:
+			self.thread_pool = ThreadPoolExecutor(max_workers=self.max_workers())
+		self.jobs = JobTable()
+		self.scheduler = Scheduler()
+		# Guards the scheduler and the number of tasks given to the executor
+		self.dispatch_condition = Condition()
+		self.running = 0
+		# Tasks ended before they returned, whose worker still runs them
+		self.stuck = 0
+		# {job ID: the ScheduledTask} of the tasks given to the executor, until it returns them
+		self.dispatched = {}
+		# {(query, payload): the ScheduledTask computing it}
+		self.in_flight = {}
+		# {job ID: the ScheduledTask the job waits on}, for the queued and running jobs
+		self.tasks = {}
+		self.coalesced = 0
+		self.max_queue_depth = int(os.environ.get('JOB_QUEUE_MAX_DEPTH', 1000))
+		# Moving average of the seconds a task takes, to estimate when a full queue has room
+		self.task_seconds = 0.0
+		self.cache = cache
+		self.results = results if results is not None else create_result_store()
+		self.accepting = True
+
+		self.max_jobs = int(os.environ.get('JOB_MAX_COUNT', 10000))
+		self.max_job_age = float(os.environ.get('JOB_MAX_AGE', 3600))
+		self.evict_after_read = os.environ.get('JOB_EVICT_AFTER_READ') == '1'
+		self.compact_interval = float(os.environ.get('JOB_COMPACT_INTERVAL', 10))
+
+		# Completed once the result of a running job is saved, for the clients waiting on it
+		self.completions = {}
+		self.max_wait = float(os.environ.get('RESULTS_MAX_WAIT', 30))
+		self.waiters = BoundedSemaphore(int(os.environ.get('RESULTS_MAX_WAITERS', 32)))
+
+		self.drain_timeout = float(os.environ.get('JOB_DRAIN_TIMEOUT', 30))
+		self.queue_file = os.environ.get('JOB_QUEUE_FILE')
+		self.resumer = None
+
+		self.stopped = Event()
+		self.compactor = Thread(target=self.compact_periodically, daemon=True)
+		self.compactor.start()
+
+	def max_workers(self):
+		"""
+		Get the number of workers of the executor. A task that timed out or was abandoned gives
+		its slot to the next task, but a thread can not be stopped and keeps its worker until
+		it returns, so the executor has twice as many workers as tasks run at once. No task is
+		dispatched while such tasks hold all the other workers. The worker process of such a
+		task is terminated instead (see terminate).
+
+		Returns:
+			int: The number of workers.
+		"""
+		return 2 * self.num_threads
 
-	def update_task_status(self, future):
+	def executor(self):
 		"""
-		Update task status and save result to a JSON file.
+		Get the executor running the tasks, starting the worker processes of the process
+		backend on the first call.
+
+		Returns:
+			concurrent.futures.Executor: The executor.
+		"""
+		with self.executor_lock:
+			if self.thread_pool is None:
+				if self.dataset is not None and self.shared is None:
+					self.shared = self.dataset().export_shared()
+				# Forking a process that already runs threads is unsafe, the workers are spawned
+				context = multiprocessing.get_context('spawn')
+				if self.starts is None:
+					self.starts = context.SimpleQueue()
+					Thread(target=self.listen_starts, daemon=True).start()
+				self.thread_pool = ProcessPoolExecutor(max_workers=self.max_workers(),
+													   mp_context=context,
+													   initializer=init_worker,
+													   initargs=(self.csv_path, self.shared,
+																 self.starts))
+			return self.thread_pool
+
+	def replace_executor(self, executor):
+		"""
+		Detach an executor of the process backend that lost a worker, the next tasks start a
+		new one.
 
 		Parameters:
-			future (concurrent.futures.Future): The future object representing the result of a task.
+			executor (ProcessPoolExecutor): The executor.
 
 		Returns:
 			None
 		"""
-		task_result = future.result()
-		job_id = task_result[0]
-		data = task_result[1]
+		with self.executor_lock:
+			if self.thread_pool is executor:
+				self.thread_pool = None
+		executor.shutdown(wait=False)
 
-		with open(f"results/{job_id}.json", "w") as f:
-			json.dump(data, f)
+	def terminate(self, task, pid):
+		"""
+		Stop the worker process still running a task that ended early. A ProcessPoolExecutor
+		can not lose a worker, so it is replaced first, and the other tasks it was running
+		run again on the new one.
 
-		self.data[str(job_id)] = {"status": "done"}
+		Parameters:
+			task (ScheduledTask): The task.
+			pid (int): The ID of the worker process running the task.
 
-	def add_task(self, data, query):
+		Returns:
+			None
+		"""
+		self.replace_executor(task.executor)
+		try:
+			os.kill(pid, signal.SIGTERM)
+		except ProcessLookupError:
+			pass
+
+	def refresh_dataset(self, change=None):
+		"""
+		Change the dataset and replace the worker processes of the process backend, which hold
+		the previous one. The executor and its shared dataset are detached before the change,
+		so no task dispatched once the new version is visible runs on the previous workers (and
+		has its result cached under the new version). The new tasks start new workers on the
+		new dataset, while a background thread waits for the previous workers to finish their
+		tasks before releasing the previous shared dataset.
+
+		Parameters:
+			change (callable): Changes the dataset and its version, or None if it already changed.
+
+		Returns:
+			any: What change returns.
+		"""
+		executor, shared = None, None
+		try:
+			with self.executor_lock:
+				if self.executor_type == 'process':
+					executor, shared = self.thread_pool, self.shared
+					self.thread_pool, self.shared = None, None
+				return change() if change is not None else None
+		finally:
+			if executor is not None or shared is not None:
+				Thread(target=self.retire_executor, args=(executor, shared), daemon=True).start()
+
+	def retire_executor(self, executor, shared):
+		"""
+		Wait for the workers of a detached executor to finish their tasks, then release the
+		shared dataset they used.
+
+		Parameters:
+			executor (ProcessPoolExecutor): The executor, or None.
+			shared (SharedDataset): The shared dataset, or None.
+
+		Returns:
+			None
+		"""
+		if executor is not None:
+			executor.shutdown()
+		if shared is not None:
+			shared.close()
+
+	def save_result(self, job_id, data):
+		"""
+		Save the encoded result of a task to the result store and mark the task as done.
+
+		Parameters:
+			job_id (int): The ID of the task.
+			data (bytes): The result of the task, encoded as JSON.
+
+		Returns:
+			None
+		"""
+		self.results.put(str(job_id), data)
+
+		self.jobs.set_status(job_id, "done")
+
+	def lookup_cache(self, data, query):
+		"""
+		Check that new tasks are accepted and look the task up in the cache.
+
+		Parameters:
+			data (dict): Data to be passed to the task.
+			query (callable): The function computing the result of the task.
+
+		Returns:
+			tuple: The cache key (None without a cache), the version of the data and the cached
+			encoded result, or None on a miss.
+		"""
+		# Same behaviour as the executor, even for the jobs served from the cache
+		if not self.accepting:
+			raise ShuttingDown()
+
+		if self.cache is None:
+			return None, None, None
+
+		cache_key = self.cache.make_key(query, data)
+		found, result, generation = self.cache.get(cache_key)
+		return cache_key, generation, result if found else None
+
+	def add_task(self, data, query, priority='normal', client=None, deadline=None, job_id=None):
 		"""
 		Add a task to the thread pool for execution.
 
 		Parameters:
 			data (dict): Data to be passed to the task.
 			query (callable): The function to be executed asynchronously.
+			priority (str): The priority class of the task (see scheduler.PRIORITIES).
+			client (str): The client that sent the task, for the fair queuing of the class.
+			deadline (float): The number of seconds the task can run before its job times out,
+				or None for no limit.
+			job_id (int): The ID of a resumed task, already in the job table, otherwise a new
+				ID is allocated.
 
 		Returns:
 			int: The ID of the added task.
+
+		Raises:
+			QueueFull: If JOB_QUEUE_MAX_DEPTH tasks are already waiting.
+			ShuttingDown: If the pool is draining.
 		"""
-		def callback(future):
-			self.update_task_status(future)
+		cache_key, generation, result = self.lookup_cache(data, query)
+
+		# The job is done right away, without going through the executor
+		if result is not None:
+			if job_id is None:
+				job_id = self.jobs.add("running")
+			self.save_result(job_id, result)
+			return job_id
+
+		key = cache_key if cache_key is not None else QueryCache.make_key(query, data)
+
+		with self.dispatch_condition:
+			# Single flight: the job shares the result of the identical one
+			task = self.in_flight.get(key)
+			if task is not None and task.generation == generation:
+				if job_id is None:
+					job_id = self.jobs.add("running")
+				self.completions[str(job_id)] = Future()
+				task.job_ids.append(job_id)
+				self.tasks[job_id] = task
+				self.coalesced += 1
 
-		job = TaskRunner(self.job_counter, data, query)
-		self.job_counter += 1
-		self.data[str(job.job_id)] = {"status": "running"}
+				# A queued task goes up to the most urgent class of the jobs waiting on it
+				priorities = self.scheduler.priorities
+				if (task.started is None
+					and priorities.index(priority) < priorities.index(task.priority)):
+					self.scheduler.remove(task)
+					task.priority = priority
+					self.scheduler.push(priority, task.client, task)
+				return job_id
 
-		future = self.thread_pool.submit(job.execute)
-		future.add_done_callback(callback)
+			if self.max_queue_depth > 0 and len(self.scheduler) >= self.max_queue_depth:
+				raise QueueFull(self.retry_after())
+
+			job = TaskRunner(job_id if job_id is not None else self.jobs.add("running"), data, query)
+			task = ScheduledTask(job, key, cache_key, generation, deadline, priority, client)
+			self.completions[str(job.job_id)] = Future()
+			self.tasks[job.job_id] = task
+			# Not shared if an identical job still runs on a previous version of the data
+			if key not in self.in_flight:
+				self.in_flight[key] = task
+			self.scheduler.push(priority, client, task)
+		self.dispatch()
 
 		return job.job_id
 
+	def dispatch(self):
+		"""
+		Give the next queued tasks to the executor, while it has free workers.
+
+		Returns:
+			None
+		"""
+		tasks = []
+		with self.dispatch_condition:
+			while (self.running < self.num_threads and len(self.scheduler)
+				   and self.running + self.stuck < self.max_workers()):
+				task = self.scheduler.pop()
+				task.started = time.monotonic()
+				self.dispatched[task.job.job_id] = task
+				tasks.append(task)
+				self.running += 1
+
+		for task in tasks:
+			self.submit(task)
+
+	def submit(self, task):
+		"""
+		Give a dispatched task to the executor.
+
+		Parameters:
+			task (ScheduledTask): The task.
+
+		Returns:
+			None
+		"""
+		with self.executor_lock:
+			executor = self.executor()
+			if self.executor_type == 'process':
+				future = executor.submit(execute_in_worker, task.job)
+			else:
+				future = executor.submit(self.execute_task, task)
+			task.executor = executor
+		future.add_done_callback(lambda future, task=task: self.task_finished(task, future))
+
+	def execute_task(self, task):
+		"""
+		Run a task in a worker thread of the thread backend.
+
+		Parameters:
+			task (ScheduledTask): The task.
+
+		Returns:
+			tuple: The job ID and the result of the task.
+		"""
+		self.task_started(task.job.job_id, None)
+		return task.job.execute()
+
+	def listen_starts(self):
+		"""
+		Receive the tasks the worker processes of the process backend start, forever.
+		"""
+		while True:
+			job_id, pid = self.starts.get()
+			self.task_started(job_id, pid)
+
+	def task_started(self, job_id, pid):
+		"""
+		Start the deadline of a task once a worker actually runs it. The worker process of a
+		task that already ended is terminated.
+
+		Parameters:
+			job_id (int): The job ID of the task.
+			pid (int): The ID of the worker process running the task, None for a thread.
+
+		Returns:
+			None
+		"""
+		with self.dispatch_condition:
+			task = self.dispatched.get(job_id)
+			if task is None:
+				return
+			task.pid = pid
+			ended = task.ended
+
+			if task.deadline and not ended:
+				if task.timer is not None:
+					task.timer.cancel()
+				task.timer = Timer(task.deadline, self.end_task, (task, "timeout"))
+				task.timer.daemon = True
+				task.timer.start()
+
+		if ended and pid is not None:
+			self.terminate(task, pid)
+
+	def task_finished(self, task, future):
+		"""
+		Encode and cache the result of a task the executor finished, then end the task.
+
+		Parameters:
+			task (ScheduledTask): The task.
+			future (concurrent.futures.Future): The future of the task in the executor.
+
+		Returns:
+			None
+		"""
+		with self.dispatch_condition:
+			ended = task.ended
+			retry = (not ended and task.attempts < 3
+					 and (future.cancelled() or isinstance(future.exception(), BrokenProcessPool)))
+			if ended:
+				# Ended before it returned, its worker is free again
+				self.stuck -= 1
+				self.dispatch_condition.notify_all()
+			elif retry:
+				task.attempts += 1
+			else:
+				task.returned = True
+			if not retry:
+				del self.dispatched[task.job.job_id]
+
+		if ended:
+			self.dispatch()
+			return
+		if retry:
+			# Its worker process was lost, the task runs again on new workers
+			self.replace_executor(task.executor)
+			self.submit(task)
+			return
+
+		result = None
+		try:
+			result = dumps(future.result()[1])
+			if task.cache_key is not None:
+				self.cache.put(task.cache_key, result, task.generation)
+		finally:
+			self.end_task(task, "done" if result is not None else "error", result)
+
+	def end_task(self, task, status, result=None):
+		"""
+		End a task, once: the jobs still waiting on it get the final status (and the result if
+		it is done), their waiting clients are woken up and the worker slot of the task is
+		given to the next queued task. A task ended before it returns keeps its worker thread
+		busy until then, but its result is dropped, and its worker process is terminated.
+
+		Parameters:
+			task (ScheduledTask): The task.
+			status (str): "done", "error", "timeout", "cancelled" or "abandoned".
+			result (bytes): The result of the task encoded as JSON, if it is done.
+
+		Returns:
+			None
+		"""
+		with self.dispatch_condition:
+			if task.ended:
+				return
+			task.ended = True
+
+			if self.in_flight.get(task.key) is task:
+				del self.in_flight[task.key]
+			for job_id in task.job_ids:
+				self.tasks.pop(job_id, None)
+
+			pid = None
+			if task.started is not None:
+				self.running -= 1
+				if status == "done":
+					seconds = time.monotonic() - task.started
+					self.task_seconds = 0.9 * self.task_seconds + 0.1 * seconds
+				elif not task.returned:
+					self.stuck += 1
+					pid = task.pid
+				self.dispatch_condition.notify_all()
+
+		if task.timer is not None:
+			task.timer.cancel()
+		if pid is not None:
+			self.terminate(task, pid)
+
+		for job_id in task.job_ids:
+			if status == "done":
+				self.save_result(job_id, result)
+			else:
+				self.jobs.set_status(job_id, status)
+			# Wake up the clients waiting for the result
+			self.completions.pop(str(job_id)).set_result(None)
+
+		self.dispatch()
+
+	def cancel(self, job_id):
+		"""
+		Cancel a job. A queued job is removed from the queue and becomes "cancelled", a running
+		job becomes "abandoned" and its worker slot is given to the next task. A job sharing the
+		result of an identical one is only detached from it, the others still get the result.
+
+		Parameters:
+			job_id (str): The ID of the job.
+
+		Returns:
+			dict: The status of the job, unchanged if it was already finished.
+		"""
+		with self.dispatch_condition:
+			task = self.tasks.get(int(job_id)) if job_id.isdigit() else None
+			if task is None:
+				return self.get_task_status(job_id)
+
+			if len(task.job_ids) > 1:
+				task.job_ids.remove(int(job_id))
+				del self.tasks[int(job_id)]
+				detached = True
+			else:
+				detached = False
+				if task.started is None:
+					self.scheduler.remove(task)
+
+		if detached:
+			self.jobs.set_status(job_id, "cancelled")
+			self.completions.pop(job_id).set_result(None)
+		else:
+			self.end_task(task, "cancelled" if task.started is None else "abandoned")
+
+		return self.get_task_status(job_id)
+
+	def retry_after(self):
+		"""
+		Estimate when the queue has room again, from the number of queued tasks and the time a
+		task takes. Must be called with the dispatch lock held.
+
+		Returns:
+			int: The number of seconds, at least 1.
+		"""
+		return max(1, math.ceil(len(self.scheduler) * self.task_seconds / self.num_threads))
+
+	def scheduler_stats(self):
+		"""
+		Get the queue depth and wait times of every priority class.
+
+		Returns:
+			dict: The statistics of every priority class, the number of running tasks and of
+			ended tasks still holding a worker, and the number of tasks that shared the result
+			of an identical one.
+		"""
+		with self.dispatch_condition:
+			return {"classes": self.scheduler.stats(), "running": self.running,
+					"stuck": self.stuck, "coalesced": self.coalesced}
+
+	def run_task(self, data, query):
+		"""
+		Run a task in the calling thread, for the queries cheap enough not to go through the
+		executor. The task still gets a job ID and its result can be read like any other.
+
+		Parameters:
+			data (dict): Data to be passed to the task.
+			query (callable): The function computing the result of the task.
+
+		Returns:
+			tuple: The ID of the task and its result, encoded as JSON.
+		"""
+		cache_key, generation, result = self.lookup_cache(data, query)
+		job_id = self.jobs.add("running")
+
+		if result is None:
+			try:
+				result = dumps(TaskRunner(job_id, data, query).execute()[1])
+			except Exception:
+				# Like a failed queued task, the job does not stay "running"
+				self.jobs.set_status(job_id, "error")
+				raise
+			if cache_key is not None:
+				self.cache.put(cache_key, result, generation)
+
+		self.save_result(job_id, result)
+		return job_id, result
+
 	def get_task_status(self, job_id):
 		"""
 		Get the status of a specific task.
@@ -73,19 +639,303 @@ class ThreadPool:
 		Returns:
 			dict: A dictionary containing the status of the task.
 		"""
-		if job_id not in self.data:
+		status = self.jobs.get(job_id)
+		if status is None:
 			return {"status": "not found"}
-		return self.data[job_id]
+		return status
+
+	def wait_for_task(self, job_id, timeout):
+		"""
+		Block until a running task is done, at most RESULTS_MAX_WAIT seconds. If too many
+		clients are already waiting, return right away instead.
+
+		Parameters:
+			job_id (str): The ID of the task.
+			timeout (float): The maximum number of seconds to wait.
+
+		Returns:
+			bool: True if the task is done.
+		"""
+		completion = self.completions.get(job_id)
+		if completion is None:
+			return self.get_task_status(job_id)["status"] == "done"
+
+		if not self.waiters.acquire(blocking=False):
+			return False
+
+		try:
+			completion.result(timeout=min(timeout, self.max_wait))
+			return True
+		except FutureTimeoutError:
+			return False
+		finally:
+			self.waiters.release()
 
-	def graceful_shutdown(self):
+	def get_result(self, job_id):
 		"""
-		Gracefully shutdown the thread pool.
+		Get the result of a finished task.
+
+		Parameters:
+			job_id (str): The ID of the task.
+
+		Returns:
+			bytes: The result of the task, encoded as JSON.
+
+		Raises:
+			KeyError: If the result is not available anymore.
+		"""
+		return self.results.get(job_id)
+
+	def forget(self, job_ids):
+		"""
+		Remove jobs from the job table and their results from the result store.
+
+		Parameters:
+			job_ids (list): The IDs of the jobs.
+
+		Returns:
+			None
+		"""
+		self.jobs.remove(job_ids)
+		for job_id in job_ids:
+			self.results.delete(str(job_id))
+
+	def compact(self):
+		"""
+		Remove the finished jobs that are past the retention policy.
+
+		Returns:
+			int: The number of removed jobs.
+		"""
+		expired = self.jobs.expired(self.max_jobs, self.max_job_age)
+		if expired:
+			self.forget(expired)
+		return len(expired)
+
+	def compact_periodically(self):
+		"""
+		Run the compaction every JOB_COMPACT_INTERVAL seconds, until the pool is shut down.
+		"""
+		while not self.stopped.wait(self.compact_interval):
+			self.compact()
+
+	def persist_queue(self):
+		"""
+		Take the queued tasks out of the queue and save them to JOB_QUEUE_FILE, one entry per
+		job waiting on them, so the next start can resume them under the same job IDs.
+
+		Returns:
+			int: The number of saved jobs.
+		"""
+		with self.dispatch_condition:
+			queued = self.scheduler.pop_all()
+			for _, _, task in queued:
+				task.ended = True
+				if self.in_flight.get(task.key) is task:
+					del self.in_flight[task.key]
+				for job_id in task.job_ids:
+					del self.tasks[job_id]
+
+		entries = [{"job_id": job_id, "query": task.job.query.__name__, "data": task.job.data,
+					"priority": priority, "client": client, "deadline": task.deadline}
+				   for priority, client, task in queued for job_id in task.job_ids]
+		if entries:
+			with open(f"{self.queue_file}.tmp", "w") as f:
+				json.dump(entries, f)
+			os.replace(f"{self.queue_file}.tmp", self.queue_file)
+
+		# The jobs stay "running", their clients get the result from the next start
+		for entry in entries:
+			self.completions.pop(str(entry["job_id"])).set_result(None)
+
+		return len(entries)
+
+	def resume(self, queries):
+		"""
+		Queue again the tasks saved to JOB_QUEUE_FILE by the drain of the previous start, under
+		their job IDs, then remove the file. Must be called before the pool takes new tasks.
+		The job IDs are restored right away, but the tasks are queued by a background thread:
+		queuing a task looks up the cache, which waits for the dataset to be loaded.
+
+		Parameters:
+			queries (dict): The functions computing the results of the tasks, by name.
+
+		Returns:
+			int: The number of resumed jobs.
+		"""
+		if not self.queue_file:
+			return 0
+
+		try:
+			with open(self.queue_file) as f:
+				entries = json.load(f)
+		except FileNotFoundError:
+			return 0
+		os.remove(self.queue_file)
+
+		for entry in entries:
+			self.jobs.restore(entry["job_id"], "running")
+
+		self.resumer = Thread(target=self.queue_resumed, args=(entries, queries), daemon=True)
+		self.resumer.start()
+		return len(entries)
+
+	def queue_resumed(self, entries, queries):
+		"""
+		Queue the tasks of the resumed jobs, whose IDs are already restored. The jobs of an
+		unknown query, or refused by the pool, end as "error".
+
+		Parameters:
+			entries (list): The saved jobs.
+			queries (dict): The functions computing the results of the tasks, by name.
+
+		Returns:
+			None
+		"""
+		for entry in entries:
+			query = queries.get(entry["query"])
+			try:
+				if query is None:
+					raise KeyError(entry["query"])
+				self.add_task(entry["data"], query, entry["priority"], entry["client"],
+							  entry["deadline"], entry["job_id"])
+			except (KeyError, QueueFull, ShuttingDown):
+				self.jobs.set_status(entry["job_id"], "error")
+
+	def graceful_shutdown(self, timeout=None):
+		"""
+		Drain the thread pool: the new tasks are refused with ShuttingDown, the queued tasks are
+		run (or saved to JOB_QUEUE_FILE if set) and the running ones are waited for. The tasks
+		still unfinished after the timeout are abandoned. The result store is flushed last.
+
+		Parameters:
+			timeout (float): The maximum number of seconds to wait, JOB_DRAIN_TIMEOUT if not given.
+
+		Returns:
+			dict: The number of jobs that finished during the drain, that were abandoned or
+			cancelled at the timeout, and that were saved to be resumed.
+		"""
+		self.accepting = False
+		self.stopped.set()
+
+		persisted = self.persist_queue() if self.queue_file else 0
+
+		with self.dispatch_condition:
+			pending = len(self.tasks)
+			drained = self.dispatch_condition.wait_for(
+				lambda: not self.running and not len(self.scheduler),
+				self.drain_timeout if timeout is None else timeout)
+
+			queued = [task for _, _, task in self.scheduler.pop_all()]
+			running = {id(task): task for task in self.tasks.values() if task.started is not None}
+
+		cancelled = sum(len(task.job_ids) for task in queued)
+		abandoned = sum(len(task.job_ids) for task in running.values())
+		for task in queued:
+			self.end_task(task, "cancelled")
+		for task in running.values():
+			self.end_task(task, "abandoned")
+
+		with self.executor_lock:
+			if self.thread_pool is not None:
+				# The abandoned tasks, and those that timed out before, are not waited for
+				self.thread_pool.shutdown(wait=drained and not self.stuck, cancel_futures=True)
+		self.results.flush()
+
+		# The workers are gone, nothing uses the shared dataset anymore
+		if self.shared is not None:
+			self.shared.close()
+			self.shared = None
+
+		return {"drained": pending - cancelled - abandoned, "abandoned": abandoned,
+				"cancelled": cancelled, "persisted": persisted}
+
+def init_worker(csv_path, shared=None, starts=None):
+	"""
+	Initialize a worker process of the process backend, attaching to the shared dataset once
+	before the worker runs any query instead of sending it with every task. Without a shared
+	dataset, the worker loads its own copy once.
+
+	Parameters:
+		csv_path (str): The path to the CSV file containing the data.
+		shared (SharedDataset): The dataset exported by the server, or None.
+		starts (SimpleQueue): The queue the worker reports the tasks it starts to.
+
+	Returns:
+		None
+	"""
+	global task_starts
+	task_starts = starts
+
+	# Imported here, the worker process only needs the app once it starts
+	from app import webserver
+
+	# The worker would otherwise outlive a server that was killed, keeping the shared dataset
+	parent = multiprocessing.parent_process()
+	if parent is not None:
+		Thread(target=lambda: (parent.join(), os._exit(1)), daemon=True).start()
+
+	if shared is not None:
+		webserver.data_ingestor = shared.attach()
+	else:
+		# Loaded by the first task
+		webserver.csv_path = csv_path
+
+def execute_in_worker(job):
+	"""
+	Run a task in a worker process of the process backend, after reporting to the server
+	that this process started it.
+
+	Parameters:
+		job (TaskRunner): The task.
+
+	Returns:
+		tuple: The job ID and the result of the task.
+	"""
+	if task_starts is not None:
+		task_starts.put((job.job_id, os.getpid()))
+	return job.execute()
+
+class ScheduledTask:
+	"""
+	Class holding the state of a task in the server process, from its submission to its end.
+	Unlike the TaskRunner, it is never sent to a worker process.
+	"""
+	def __init__(self, job, key, cache_key, generation, deadline, priority, client):
+		"""
+		Initialize the ScheduledTask.
+
+		Parameters:
+			job (TaskRunner): The task run by the executor.
+			key (tuple): The query and its normalized payload, shared by the identical tasks.
+			cache_key (tuple): The key under which the result is cached, or None.
+			generation (any): The version of the data the task was submitted on.
+			deadline (float): The number of seconds the task can run, or None for no limit.
+			priority (str): The priority class the task is queued in.
+			client (str): The client the task is queued for.
 		"""
-		self.thread_pool.shutdown()
+		self.job = job
+		self.key = key
+		self.cache_key = cache_key
+		self.generation = generation
+		self.deadline = deadline
+		self.priority = priority
+		self.client = client
+		# The jobs waiting for the result: the task's own job and the identical ones
+		self.job_ids = [job.job_id]
+		# Set when the task is dispatched, then by the executor running it
+		self.started = None
+		self.executor = None
+		self.pid = None
+		self.attempts = 0
+		self.timer = None
+		self.returned = False
+		self.ended = False
 
-class TaskRunner(Thread):
+class TaskRunner:
 	"""
-	Class representing a task runner thread.
+	Class representing a task run by the executor. It only holds picklable state, so it can
+	be sent to a worker process.
 	"""
 	def __init__(self, job_id, data, query):
 		"""
@@ -96,7 +946,6 @@ class TaskRunner(Thread):
 			data (dict): Data to be passed to the task.
 			query (callable): The function to be executed asynchronously.
 		"""
-		Thread.__init__(self)
 		self.job_id = job_id
 		self.data = data
 		self.query = query
@@ -0,0 +1,67 @@
+"""
+Measure the query throughput of the thread and the process executor backends as the
+number of workers grows. The benchmark query is a full filter + groupby over the dataset,
+to keep the workers CPU bound.
+
+Usage: python benchmarks/bench_executors.py [jobs] [max_workers]
+"""
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import webserver, CSV_PATH
+from app.task_runner import ThreadPool
+
+
+def unindexed_states_mean(data):
+    data_frame = webserver.data_ingestor.data
+    filtered_data = data_frame[data_frame['Question'] == data['question']]
+    return filtered_data.groupby('LocationDesc', observed=True)['Data_Value'].mean().to_dict()
+
+
+def throughput(executor_type, num_workers, jobs, question):
+    os.environ['TP_EXECUTOR'] = executor_type
+    os.environ['TP_NUM_OF_THREADS'] = str(num_workers)
+    pool = ThreadPool(csv_path=CSV_PATH, dataset=lambda: webserver.data_ingestor)
+
+    # Start all the workers (and attach to the dataset in the worker processes) before
+    # timing, with distinct payloads so the warm-up jobs are not coalesced into one
+    warmup = [pool.add_task({'question': question, 'warmup': i}, unindexed_states_mean)
+              for i in range(pool.max_workers())]
+    for job_id in warmup:
+        while not pool.wait_for_task(str(job_id), 120):
+            pass
+
+    start = time.perf_counter()
+    job_ids = [pool.add_task({'question': question, 'i': i}, unindexed_states_mean)
+               for i in range(jobs)]
+    for job_id in job_ids:
+        while not pool.wait_for_task(str(job_id), 120):
+            pass
+    elapsed = time.perf_counter() - start
+
+    pool.graceful_shutdown()
+    return jobs / elapsed
+
+
+def main():
+    jobs = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    max_workers = int(sys.argv[2]) if len(sys.argv) > 2 else os.cpu_count()
+    question = webserver.data_ingestor.questions[0]
+
+    worker_counts = [1]
+    while worker_counts[-1] * 2 <= max_workers:
+        worker_counts.append(worker_counts[-1] * 2)
+    if worker_counts[-1] != max_workers:
+        worker_counts.append(max_workers)
+
+    print(f"{'workers':>8}{'thread (jobs/s)':>18}{'process (jobs/s)':>18}")
+    for num_workers in worker_counts:
+        print(f"{num_workers:>8}{throughput('thread', num_workers, jobs, question):>18.1f}"
+              f"{throughput('process', num_workers, jobs, question):>18.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Measure the latency of get_results for a large result (mean_by_category), comparing the
+previous path (read results/<job_id>.json, decode it and re-encode it with jsonify) with
+the pre-encoded result spliced into the response envelope.
+
+Usage: python benchmarks/bench_get_results.py [repeat]
+"""
+import json
+import os
+import sys
+import tempfile
+import time
+import timeit
+
+from flask import jsonify
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app import webserver
+from app import routes
+from app.json_codec import dumps, envelope
+
+
+def main():
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+
+    data = {'question': webserver.data_ingestor.questions[0]}
+    result = routes.api_mean_by_category(data)
+
+    client = webserver.test_client()
+    job_id = client.post('/api/mean_by_category', json=data).get_json()['job_id']
+    while client.get(f'/api/get_results/{job_id}').get_json()['status'] != 'done':
+        time.sleep(0.01)
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, f'{job_id}.json')
+        with open(path, 'w') as f:
+            json.dump(result, f)
+
+        def decode_and_jsonify():
+            with open(path, 'r') as f:
+                return jsonify({'status': 'done', 'data': json.load(f)}).get_data()
+
+        with webserver.app_context():
+            before = timeit.timeit(decode_and_jsonify, number=repeat)
+
+    payload = dumps(result)
+    with webserver.app_context():
+        splice = timeit.timeit(lambda: webserver.response_class(envelope('done', payload),
+                                    mimetype='application/json').get_data(), number=repeat)
+
+    endpoint = timeit.timeit(lambda: client.get(f'/api/get_results/{job_id}').get_data(),
+                             number=repeat)
+
+    print(f"result size: {len(payload)} bytes, {len(result)} entries")
+    print(f"{'file + json.load + jsonify (ms)':<36}{before / repeat * 1000:>10.3f}")
+    print(f"{'pre-encoded splice (ms)':<36}{splice / repeat * 1000:>10.3f}")
+    print(f"{'GET /api/get_results (ms)':<36}{endpoint / repeat * 1000:>10.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,42 @@
+"""
+Compare the memory footprint and the question filter latency of the plain CSV load
+against the schema used by DataIngestor (categorical dimensions, only the used columns).
+
+Usage: python benchmarks/bench_ingestion.py [csv_path] [repeat]
+"""
+import os
+import sys
+import timeit
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.data_ingestor import DataIngestor
+
+CSV_PATH = './nutrition_activity_obesity_usa_subset.csv'
+
+
+def memory_mb(data_frame):
+    return data_frame.memory_usage(deep=True).sum() / (1024 * 1024)
+
+
+def main():
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else CSV_PATH
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+
+    plain = pd.read_csv(csv_path)
+    ingestor = DataIngestor(csv_path)
+    question = ingestor.questions[0]
+
+    plain_filter = timeit.timeit(lambda: plain[plain['Question'] == question], number=repeat)
+    codes_filter = timeit.timeit(lambda: ingestor.select(question), number=repeat)
+
+    print(f"{'':<24}{'before':>12}{'after':>12}")
+    print(f"{'memory (MB)':<24}{memory_mb(plain):>12.2f}{memory_mb(ingestor.data):>12.2f}")
+    print(f"{'question filter (ms)':<24}{plain_filter / repeat * 1000:>12.3f}"
+          f"{codes_filter / repeat * 1000:>12.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,69 @@
+"""
+Overload the thread pool with more jobs than it can run, with and without a maximum queue
+depth, and measure the latency (submission to completion) of the accepted jobs. Without a
+limit the queue, and the latency, grow for as long as the overload lasts; with a limit the
+extra jobs are refused and the latency of the accepted ones stays bounded.
+
+Usage: python benchmarks/bench_overload.py [seconds] [overload_factor]
+"""
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.result_store import MemoryResultStore
+from app.task_runner import QueueFull, ThreadPool
+
+WORKERS = 4
+SERVICE_SECONDS = 0.005
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+def overload(max_depth, seconds, factor):
+    os.environ['TP_NUM_OF_THREADS'] = str(WORKERS)
+    os.environ['JOB_QUEUE_MAX_DEPTH'] = str(max_depth)
+    pool = ThreadPool(results=MemoryResultStore(1000000, 0))
+    latencies = []
+    lock = threading.Lock()
+
+    def slow_query(data):
+        time.sleep(SERVICE_SECONDS)
+        with lock:
+            latencies.append(time.monotonic() - data['submitted'])
+
+    interval = SERVICE_SECONDS / WORKERS / factor
+    accepted = rejected = 0
+    start = time.monotonic()
+    next_submission = start
+    while time.monotonic() - start < seconds:
+        try:
+            pool.add_task({'submitted': time.monotonic()}, slow_query, 'normal', 'load')
+            accepted += 1
+        except QueueFull:
+            rejected += 1
+        next_submission += interval
+        time.sleep(max(0.0, next_submission - time.monotonic()))
+
+    pool.graceful_shutdown()
+    return accepted, rejected, percentile(latencies, 0.5), percentile(latencies, 0.99)
+
+
+def main():
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 5
+    factor = float(sys.argv[2]) if len(sys.argv) > 2 else 2
+
+    print(f"{'max depth':>10}{'accepted':>10}{'rejected':>10}{'p50 (ms)':>10}{'p99 (ms)':>10}")
+    for max_depth in [0, 100, 20]:
+        accepted, rejected, p50, p99 = overload(max_depth, seconds, factor)
+        label = max_depth if max_depth else 'none'
+        print(f"{label:>10}{accepted:>10}{rejected:>10}{p50 * 1000:>10.1f}{p99 * 1000:>10.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Measure the time DataIngestor takes to load the dataset on a cold start, parsing the CSV and
+saving its binary columnar copy, and on a warm start, loading the columns from that copy.
+
+Usage: python benchmarks/bench_startup.py [csv_path] [repeat]
+"""
+import os
+import shutil
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.column_cache import ColumnCache
+from app.data_ingestor import DataIngestor
+
+CSV_PATH = './nutrition_activity_obesity_usa_subset.csv'
+
+
+def best_time(load, repeat, before=None):
+    times = []
+    for _ in range(repeat):
+        if before is not None:
+            before()
+        start = time.perf_counter()
+        load()
+        times.append(time.perf_counter() - start)
+    return min(times) * 1000
+
+
+def main():
+    csv_path = sys.argv[1] if len(sys.argv) > 1 else CSV_PATH
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    cache = ColumnCache(csv_path)
+
+    def remove_cache():
+        shutil.rmtree(cache.directory, ignore_errors=True)
+
+    cold_read = best_time(lambda: DataIngestor.read_csv(csv_path), repeat, remove_cache)
+    cold_start = best_time(lambda: DataIngestor(csv_path), repeat, remove_cache)
+    warm_read = best_time(lambda: DataIngestor.read_csv(csv_path), repeat)
+    warm_start = best_time(lambda: DataIngestor(csv_path), repeat)
+
+    print(f"{'':<24}{'cold (ms)':>12}{'warm (ms)':>12}")
+    print(f"{'load columns':<24}{cold_read:>12.2f}{warm_read:>12.2f}")
+    print(f"{'DataIngestor':<24}{cold_start:>12.2f}{warm_start:>12.2f}")
+
+
+if __name__ == '__main__':
+    main()
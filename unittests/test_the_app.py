@@ -1,9 +1,66 @@
 import json
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+import tracemalloc
 import unittest
+from unittest import mock
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
 import pandas as pd
+from flask import jsonify
 
 from app import webserver
 from app import routes
+from app.column_cache import ColumnCache
+from app.data_ingestor import DataIngestor, SCHEMA
+from app.job_table import JobTable
+from app.query_cache import QueryCache
+from app.server import Webserver
+from app.result_store import MemoryResultStore, DiskResultStore, WriteBehindResultStore
+from app.rate_limiter import RateLimiter
+from app.task_runner import QueueFull, ShuttingDown, ThreadPool
+
+def private_memory():
+    # kB of private (anonymous) memory of the current process
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('RssAnon:'):
+                return int(line.split()[1]) * 1024
+
+worker_barrier = None
+
+def wait_for_workers(barrier):
+    # Initializer of the worker processes
+    global worker_barrier
+    worker_barrier = barrier
+
+def attach_and_read(shared):
+    # Wait for every worker to start, so each one attaches to the dataset
+    worker_barrier.wait(60)
+    before = private_memory()
+    data_ingestor = shared.attach()
+    total = data_ingestor.data['Data_Value'].sum()
+    codes = data_ingestor.data['Question'].cat.codes.max()
+    return private_memory() - before, float(total), int(codes)
+
+def single_worker_pool():
+    # Pool running one task at a time, and a query blocked until the returned gate is set
+    with mock.patch.dict(os.environ, {'TP_NUM_OF_THREADS': '1', 'TP_EXECUTOR': 'thread'}):
+        pool = ThreadPool(results=MemoryResultStore(100, 0))
+    gate = threading.Event()
+
+    def blocking(data):
+        gate.wait(10)
+        return data
+
+    return pool, gate, blocking
+
+def sleeping(data):
+    time.sleep(data['seconds'])
+    return data
 
 class Test(unittest.TestCase):
     # read the data from the read.csv file
@@ -19,8 +76,8 @@ class Test(unittest.TestCase):
     def test_post_req_for_states_mean(self):
         webserver.test_client().get('api/graceful_shutdown')
         res = webserver.test_client().post('/api/states_mean', json={"question": self.data['Question'].iloc[0]})
-        # expected to get a 500 status code as the server is shutdown
-        self.assertEqual(res.status_code, 500)
+        # expected to get a 503 status code as the server is shutdown
+        self.assertEqual(res.status_code, 503)
 
     def test_api_states_mean(self):
         # use the function from routes to the the states mean and take the data from in-1.json
@@ -183,6 +240,687 @@ class Test(unittest.TestCase):
         with self.assertRaises(KeyError):
             routes.api_state_diff_from_mean(data)
 
+    def test_cache_hit_is_done_immediately(self):
+        data = {'question': self.data['Question'].iloc[0]}
+        client = webserver.test_client()
+
+        job_id = client.post('/api/states_mean', json=data).get_json()['job_id']
+        while client.get(f'/api/get_results/{job_id}').get_json()['status'] != 'done':
+            time.sleep(0.01)
+
+        hits = webserver.query_cache.stats()['hits']
+        job_id = client.post('/api/states_mean', json=data).get_json()['job_id']
+
+        self.assertEqual(webserver.query_cache.stats()['hits'], hits + 1)
+        self.assertEqual(webserver.tasks_runner.get_task_status(str(job_id)), {'status': 'done'})
+
+    def test_cache_lru_eviction_and_invalidation(self):
+        generation = [1]
+        cache = QueryCache(lambda: generation[0])
+        cache.max_size = 2
+
+        cache.put('a', 1, 1)
+        cache.put('b', 2, 1)
+        cache.get('a')
+        cache.put('c', 3, 1)
+
+        self.assertEqual(cache.get('a')[:2], (True, 1))
+        self.assertEqual(cache.get('b')[:2], (False, None))
+
+        # Reloading the data empties the cache
+        generation[0] = 2
+        self.assertEqual(cache.get('a')[:2], (False, None))
+
+    def test_concurrent_submissions_get_unique_job_ids(self):
+        question = self.data['Question'].iloc[0]
+        states = self.data['LocationDesc'].unique()
+
+        def submit(i):
+            client = webserver.test_client()
+            data = {'question': question, 'state': states[i % len(states)]}
+            job_id = client.post('/api/state_mean', json=data).get_json()['job_id']
+            # Read the whole table while other threads keep adding jobs
+            client.get('/api/jobs')
+            return job_id
+
+        with ThreadPoolExecutor(max_workers=32) as executor:
+            job_ids = list(executor.map(submit, range(2000)))
+
+        self.assertEqual(len(set(job_ids)), len(job_ids))
+
+        for job_id in job_ids:
+            while webserver.tasks_runner.get_task_status(str(job_id))['status'] == 'running':
+                time.sleep(0.01)
+            self.assertEqual(webserver.tasks_runner.get_task_status(str(job_id)), {'status': 'done'})
+
+        jobs = webserver.test_client().get('/api/jobs').get_json()
+        self.assertTrue(all(str(job_id) in jobs for job_id in job_ids))
+
+    def test_admission_control(self):
+        limiter = RateLimiter(1, 2)
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.assertEqual(limiter.acquire('a'), 0)
+        self.assertGreater(limiter.acquire('a'), 0)
+        self.assertEqual(limiter.acquire('b'), 0)
+
+        rate_limiter = webserver.rate_limiter
+        webserver.rate_limiter = RateLimiter(0.001, 1)
+        try:
+            client = webserver.test_client()
+            data = {'question': webserver.data_ingestor.questions[0]}
+            res = client.post('/api/global_mean', json=data, headers={'X-Client-Id': 'test'})
+            self.assertEqual(res.status_code, 200)
+            # Changing the client ID does not get around the limit
+            res = client.post('/api/global_mean', json=data, headers={'X-Client-Id': 'other'})
+            self.assertEqual(res.status_code, 429)
+            self.assertGreaterEqual(int(res.headers['Retry-After']), 1)
+        finally:
+            webserver.rate_limiter = rate_limiter
+
+        # Nor does it get more turns of the fair queuing
+        with webserver.test_request_context(headers={'X-Client-Id': 'test'}):
+            first = routes.client_id()
+        with webserver.test_request_context(headers={'X-Client-Id': 'other'}):
+            self.assertEqual(routes.client_id(), first)
+
+        pool, gate, blocking = single_worker_pool()
+        pool.max_queue_depth = 2
+        job_ids = [pool.add_task({'i': i}, blocking) for i in range(3)]
+        with self.assertRaises(QueueFull) as context:
+            pool.add_task({'i': 3}, blocking)
+        self.assertGreaterEqual(context.exception.retry_after, 1)
+
+        gate.set()
+        for job_id in job_ids:
+            self.assertTrue(pool.wait_for_task(str(job_id), 10))
+        pool.graceful_shutdown()
+
+    def test_all_questions_statistics(self):
+        states_mean_all = routes.api_states_mean_all({})
+        best5_all = routes.api_best5_all({})
+        worst5_all = routes.api_worst5_all({})
+
+        for question in self.data['Question'].unique():
+            data = {'question': question}
+            states_mean = {state: value for state, value in routes.api_states_mean(data).items()
+                           if value == value}
+
+            self.assertEqual(states_mean_all[question], states_mean)
+            self.assertEqual(best5_all[question], routes.api_best5(data))
+            self.assertEqual(worst5_all[question], routes.api_worst5(data))
+
+    def test_append_rows(self):
+        original = webserver.data_ingestor
+        webserver.data_ingestor = DataIngestor(original.csv_path, original.data, original.index)
+        client = webserver.test_client()
+        question = original.questions[0]
+        rows = pd.DataFrame({'Question': [question] * 3, 'LocationDesc': ['Ohio', 'Ohio', 'Atlantis'],
+                             'StratificationCategory1': ['Total'] * 3, 'Stratification1': ['Total'] * 3,
+                             'Data_Value': [10.0, 90.0, 50.0]})
+        try:
+            client.post('/api/states_mean?sync=1', json={'question': question})
+            previous_index = webserver.data_ingestor.index
+            stale = webserver.data_ingestor.get_matrices()
+
+            res = client.post('/api/admin/append', data=rows.to_csv(index=False), content_type='text/csv')
+            self.assertEqual(res.status_code, 200)
+            self.assertEqual(res.get_json()['rows'], 3)
+
+            jsonl = rows.head(1).to_json(orient='records', lines=True)
+            res = client.post('/api/admin/append', data=jsonl, content_type='application/x-ndjson')
+            self.assertEqual(res.get_json()['rows'], 1)
+
+            res = client.post('/api/admin/append', data='Question\nx\n', content_type='text/csv')
+            self.assertEqual(res.status_code, 400)
+
+            # The loaded rows are only rebuilt when they are read
+            self.assertEqual(len(webserver.data_ingestor.appended), 2)
+
+            # Same aggregates as the whole dataset indexed at once
+            expected = DataIngestor(original.csv_path, pd.concat([original.data, rows, rows.head(1)]).astype(SCHEMA))
+            res = client.post('/api/states_mean?sync=1', json={'question': question}).get_json()
+            expected_means = expected.get_index(question).state_means()
+            self.assertEqual(list(res['data']), sorted(expected_means))
+            np.testing.assert_allclose([res['data'][state] for state in sorted(expected_means)],
+                                       [expected_means[state] for state in sorted(expected_means)], rtol=1e-12)
+            self.assertEqual(len(webserver.data_ingestor.data), len(original.data) + 4)
+            self.assertEqual(len(webserver.data_ingestor.select(question, 'Atlantis')), 1)
+            # Matrices stored late from the previous index are not served
+            webserver.data_ingestor.matrices = (previous_index, *stale)
+            self.assertIn('Atlantis', webserver.data_ingestor.get_matrices()[0].index)
+            # The index of the replaced dataset is not modified
+            self.assertNotIn('Atlantis', original.get_index(question).states)
+        finally:
+            webserver.data_ingestor = original
+
+    def test_append_rows_seen_by_worker_processes(self):
+        original = webserver.data_ingestor
+        dataset = DataIngestor(original.csv_path, original.data, original.index)
+        with mock.patch.dict(os.environ, {'TP_EXECUTOR': 'process', 'TP_NUM_OF_THREADS': '1'}):
+            pool = ThreadPool(QueryCache(lambda: dataset.version), MemoryResultStore(100, 0),
+                              original.csv_path, lambda: dataset)
+        data = {'question': original.questions[0]}
+
+        # The workers start on the previous rows
+        job_id = pool.add_task(data, routes.api_states_mean)
+        self.assertTrue(pool.wait_for_task(str(job_id), 30))
+
+        rows = pd.DataFrame({'Question': [data['question']] * 50, 'LocationDesc': ['Ohio'] * 50,
+                             'StratificationCategory1': ['Total'] * 50, 'Stratification1': ['Total'] * 50,
+                             'Data_Value': [1000.0] * 50})
+
+        def append():
+            # The previous workers are detached before the new version is visible
+            self.assertIsNone(pool.thread_pool)
+            return dataset.append(rows)
+
+        self.assertEqual(pool.refresh_dataset(append), 50)
+
+        # The first job after the append already runs on the new rows, and so does the cache
+        expected = dataset.get_index(data['question']).state_means()['Ohio']
+        for _ in range(2):
+            job_id = pool.add_task(data, routes.api_states_mean)
+            self.assertTrue(pool.wait_for_task(str(job_id), 30))
+            self.assertAlmostEqual(json.loads(pool.get_result(str(job_id)))['Ohio'], expected)
+        pool.graceful_shutdown()
+
+    def test_batch_request(self):
+        questions = self.data['Question'].unique()[:2]
+        state = self.data['LocationDesc'].iloc[0]
+        requests = [dict(endpoint=endpoint, question=question, state=state)
+                    for question in questions
+                    for endpoint in ['states_mean', 'best5', 'worst5', 'state_diff_from_mean']]
+        client = webserver.test_client()
+
+        job_id = client.post('/api/batch', json={'requests': requests}).get_json()['job_id']
+        res = client.get(f'/api/get_results/{job_id}?wait=5').get_json()
+
+        expected = [getattr(routes, 'api_' + item['endpoint'])(item) for item in requests]
+        self.assertEqual(res['status'], 'done')
+        self.assertEqual(res['data'], json.loads(json.dumps(expected)))
+
+        res = client.post('/api/batch', json={'requests': [{'endpoint': 'fake', 'question': questions[0]}]})
+        self.assertEqual(res.status_code, 400)
+
+    def test_best_and_worst_k(self):
+        client = webserver.test_client()
+        for question in webserver.data_ingestor.questions:
+            data = self.data[self.data['Question'] == question]
+            state_means = data.groupby('LocationDesc')['Data_Value'].mean().sort_values()
+            if question not in webserver.data_ingestor.questions_best_is_min:
+                state_means = state_means.sort_values(ascending=False)
+
+            best = client.post('/api/best5?sync=1', json={'question': question, 'k': 10}).get_json()['data']
+            worst = client.post('/api/worst5?sync=1', json={'question': question, 'k': 20}).get_json()['data']
+            self.assertEqual(set(best), set(state_means.head(10).index))
+            self.assertEqual(set(worst), set(state_means.tail(20).index))
+            self.assertEqual(list(routes.api_best5({'question': question, 'k': 10})), list(state_means.head(10).index))
+            self.assertEqual(routes.api_best5({'question': question, 'k': 5}), routes.api_best5({'question': question}))
+
+        for k in [0, -1, 'a', True]:
+            res = client.post('/api/best5', json={'question': question, 'k': k})
+            self.assertEqual(res.status_code, 400)
+
+    def test_blocking_get_results_waits_for_job(self):
+        data = {'question': self.data['Question'].iloc[0], 'state': self.data['LocationDesc'].iloc[1]}
+        client = webserver.test_client()
+
+        job_id = client.post('/api/state_mean_by_category', json=data).get_json()['job_id']
+        res = client.get(f'/api/get_results/{job_id}?wait=5').get_json()
+
+        # A single request is enough, the job is waited for
+        self.assertEqual(res['status'], 'done')
+        self.assertEqual(res['data'], routes.api_state_mean_by_category(data))
+
+    def test_cancelled_and_timed_out_jobs(self):
+        pool, gate, blocking = single_worker_pool()
+
+        blocker = pool.add_task({'i': 0}, blocking)
+        queued = pool.add_task({'i': 1}, blocking)
+        self.assertEqual(pool.cancel(str(queued)), {'status': 'cancelled'})
+        self.assertEqual(pool.scheduler_stats()['classes']['normal']['queued'], 0)
+
+        # The worker slot of the abandoned job goes to the next one
+        nxt = pool.add_task({'i': 2}, lambda data: data)
+        self.assertEqual(pool.cancel(str(blocker)), {'status': 'abandoned'})
+        self.assertTrue(pool.wait_for_task(str(nxt), 10))
+        self.assertEqual(pool.get_result(str(nxt)), b'{"i":2}')
+
+        timed_out = pool.add_task({'i': 3}, blocking, deadline=0.1)
+        self.assertTrue(pool.wait_for_task(str(timed_out), 10))
+        self.assertEqual(pool.get_task_status(str(timed_out)), {'status': 'timeout'})
+        self.assertEqual(pool.scheduler_stats()['running'], 0)
+
+        # Both workers are held by the hung jobs, the next job waits for one of them instead
+        # of timing out before it runs
+        waiting = pool.add_task({'i': 4}, lambda data: data, deadline=0.1)
+        time.sleep(0.3)
+        self.assertEqual(pool.get_task_status(str(waiting)), {'status': 'running'})
+        self.assertEqual(pool.scheduler_stats()['stuck'], 2)
+
+        gate.set()
+        self.assertTrue(pool.wait_for_task(str(waiting), 10))
+        self.assertEqual(pool.get_result(str(waiting)), b'{"i":4}')
+        pool.graceful_shutdown()
+        self.assertEqual(pool.get_task_status(str(blocker)), {'status': 'abandoned'})
+        self.assertEqual(pool.in_flight, {})
+
+        client = webserver.test_client()
+        self.assertEqual(client.delete('/api/jobs/0').status_code, 404)
+        data = {'question': self.data['Question'].iloc[0]}
+        job_id = client.post('/api/states_mean', json=data).get_json()['job_id']
+        client.get(f'/api/get_results/{job_id}?wait=5')
+        self.assertEqual(client.delete(f'/api/jobs/{job_id}').get_json(), {'status': 'done'})
+
+    def test_resumable_queries(self):
+        # Only the queries can be resumed, not the other functions of the routes
+        self.assertIn('api_batch', routes.RESUMABLE_QUERIES)
+        self.assertIn('api_states_mean_all', routes.RESUMABLE_QUERIES)
+        self.assertIn('api_state_mean', routes.RESUMABLE_QUERIES)
+        self.assertNotIn('graceful_shutdown', routes.RESUMABLE_QUERIES)
+        self.assertNotIn('reload_dataset', routes.RESUMABLE_QUERIES)
+
+        with tempfile.TemporaryDirectory() as directory:
+            pool, _, _ = single_worker_pool()
+            pool.queue_file = os.path.join(directory, 'queue.json')
+            with open(pool.queue_file, 'w') as f:
+                json.dump([{'job_id': 7, 'query': 'graceful_shutdown', 'data': {}, 'priority': 'normal',
+                            'client': None, 'deadline': None}], f)
+            self.assertEqual(pool.resume(routes.RESUMABLE_QUERIES), 1)
+            pool.resumer.join(10)
+            self.assertEqual(pool.get_task_status('7'), {'status': 'error'})
+            pool.graceful_shutdown()
+
+    def test_process_executor_queries_and_timeouts(self):
+        with mock.patch.dict(os.environ, {'TP_EXECUTOR': 'process', 'TP_NUM_OF_THREADS': '1'}):
+            pool = ThreadPool(results=MemoryResultStore(100, 0), csv_path=webserver.csv_path,
+                              dataset=lambda: webserver.data_ingestor)
+        data = {'question': self.data['Question'].iloc[0]}
+        job_id = pool.add_task(data, routes.api_global_mean)
+        self.assertTrue(pool.wait_for_task(str(job_id), 30))
+        self.assertEqual(json.loads(pool.get_result(str(job_id))), routes.api_global_mean(data))
+
+        # The worker process of a timed out job is terminated and replaced
+        timed_out = pool.add_task({'seconds': 60}, sleeping, deadline=0.5)
+        self.assertTrue(pool.wait_for_task(str(timed_out), 30))
+        self.assertEqual(pool.get_task_status(str(timed_out)), {'status': 'timeout'})
+        job_id = pool.add_task({'seconds': 0}, sleeping)
+        self.assertTrue(pool.wait_for_task(str(job_id), 30))
+        self.assertEqual(pool.get_result(str(job_id)), b'{"seconds":0}')
+        self.assertEqual(pool.scheduler_stats()['stuck'], 0)
+        pool.graceful_shutdown()
+
+    def test_graceful_drain_and_resume(self):
+        pool, gate, blocking = single_worker_pool()
+
+        with tempfile.TemporaryDirectory() as directory:
+            pool.queue_file = os.path.join(directory, 'queue.json')
+            running = pool.add_task({'i': 0}, blocking)
+            queued = pool.add_task({'i': 1}, blocking, 'bulk', 'client')
+            follower = pool.add_task({'i': 1}, blocking)
+
+            # The running job is abandoned at the deadline, the queued ones are saved
+            report = pool.graceful_shutdown(timeout=0.1)
+            self.assertEqual(report, {'drained': 0, 'abandoned': 1, 'cancelled': 0, 'persisted': 2})
+            self.assertEqual(pool.get_task_status(str(running)), {'status': 'abandoned'})
+            with self.assertRaises(ShuttingDown):
+                pool.add_task({'i': 2}, blocking)
+            gate.set()
+
+            resumed, _, _ = single_worker_pool()
+            resumed.queue_file = pool.queue_file
+            self.assertEqual(resumed.resume({'blocking': blocking}), 2)
+            self.assertFalse(os.path.exists(resumed.queue_file))
+            # The job IDs are restored at once, the jobs are queued in the background
+            self.assertIn(resumed.get_task_status(str(queued))['status'], ('running', 'done'))
+            resumed.resumer.join(10)
+            for job_id in (queued, follower):
+                self.assertTrue(resumed.wait_for_task(str(job_id), 10))
+                self.assertEqual(resumed.get_result(str(job_id)), b'{"i":1}')
+            self.assertGreater(resumed.add_task({'i': 3}, lambda data: time.sleep(0.2)), follower)
+
+            self.assertEqual(resumed.graceful_shutdown(),
+                             {'drained': 1, 'abandoned': 0, 'cancelled': 0, 'persisted': 0})
+
+    def test_graceful_drain_does_not_wait_for_stuck_tasks(self):
+        pool, gate, blocking = single_worker_pool()
+        timed_out = pool.add_task({}, blocking, deadline=0.1)
+        self.assertTrue(pool.wait_for_task(str(timed_out), 10))
+        self.assertEqual(pool.scheduler_stats()['stuck'], 1)
+
+        # The thread of the timed out task still runs, the drain deadline still holds
+        start = time.monotonic()
+        report = pool.graceful_shutdown(timeout=0.5)
+        self.assertLess(time.monotonic() - start, 5)
+        self.assertEqual(report, {'drained': 0, 'abandoned': 0, 'cancelled': 0, 'persisted': 0})
+        gate.set()
+
+    def test_fast_path_sync_query(self):
+        data = {'question': self.data['Question'].iloc[0], 'state': self.data['LocationDesc'].iloc[0]}
+        client = webserver.test_client()
+
+        res = client.post('/api/state_mean?sync=1', json=data).get_json()
+        self.assertEqual(res['status'], 'done')
+        self.assertEqual(res['data'], routes.api_state_mean(data))
+        self.assertEqual(webserver.tasks_runner.get_task_status(str(res['job_id'])), {'status': 'done'})
+
+        # Too expensive to run synchronously, it goes through the job queue
+        cost = routes.estimate_cost(routes.api_mean_by_category, data)
+        if cost > routes.SYNC_COST_THRESHOLD:
+            res = client.post('/api/mean_by_category?sync=1', json=data).get_json()
+            self.assertEqual(list(res), ['job_id'])
+
+        # A failed query does not leave its job running
+        pool = ThreadPool(results=MemoryResultStore(100, 0))
+        with self.assertRaises(KeyError):
+            pool.run_task({}, lambda data: data['state'])
+        self.assertEqual(pool.jobs.snapshot(), {'1': {'status': 'error'}})
+        pool.graceful_shutdown()
+
+    def test_data_value_dtype_unchanged(self):
+        data = {'question': self.data['Question'].iloc[0], 'state': self.data['LocationDesc'].iloc[0]}
+        dtype = webserver.data_ingestor.data['Data_Value'].dtype
+
+        for query in [routes.api_states_mean, routes.api_state_mean, routes.api_best5,
+                      routes.api_worst5, routes.api_global_mean, routes.api_diff_from_mean,
+                      routes.api_state_diff_from_mean, routes.api_mean_by_category,
+                      routes.api_state_mean_by_category]:
+            query(data)
+
+        # No endpoint should convert the shared data in place
+        self.assertEqual(webserver.data_ingestor.data['Data_Value'].dtype, dtype)
+
+    def test_streaming_ingestion(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'data.csv')
+            self.data.head(6000).to_csv(csv_path, index=False)
+            larger_csv_path = os.path.join(directory, 'larger.csv')
+            pd.concat([self.data.head(6000)] * 3).to_csv(larger_csv_path, index=False)
+
+            in_memory = DataIngestor(csv_path, chunk_size=0)
+            streamed = DataIngestor(csv_path, chunk_size=1000)
+
+            tracemalloc.start()
+            DataIngestor(csv_path, chunk_size=1000)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.reset_peak()
+            DataIngestor(larger_csv_path, chunk_size=1000)
+            larger_peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+
+        self.assertIsNone(streamed.data)
+        # The peak memory depends on the chunk size, not on the size of the file
+        self.assertLess(larger_peak, peak * 1.5)
+
+        self.assertEqual(list(streamed.index), list(in_memory.index))
+        for question, expected in in_memory.index.items():
+            question_index = streamed.get_index(question)
+            self.assertEqual(question_index.total[1], expected.total[1])
+            self.assertEqual(list(question_index.states), list(expected.states))
+
+            # The sums are added chunk by chunk, so the means can differ in the last digits
+            means = [question_index.global_mean(), question_index.exact_global_mean()]
+            expected_means = [expected.global_mean(), expected.exact_global_mean()]
+            for state in expected.states:
+                means += [question_index.state_means()[state], question_index.exact_state_mean(state)]
+                expected_means += [expected.state_means()[state], expected.exact_state_mean(state)]
+                self.assertEqual(question_index.category_means(state).keys(), expected.category_means(state).keys())
+                means += list(question_index.category_means(state).values())
+                expected_means += list(expected.category_means(state).values())
+            np.testing.assert_allclose(means, expected_means, rtol=1e-12)
+
+    def test_dataset_hot_reload(self):
+        client = webserver.test_client()
+        previous = webserver.data_ingestor
+        data = {'question': previous.questions[0]}
+        expected = client.post('/api/states_mean?sync=1', json=data).get_json()['data']
+
+        self.assertEqual(client.post('/api/admin/reload').status_code, 202)
+        for _ in range(100):
+            status = client.get('/api/admin/reload').get_json()
+            if status['status'] != 'reloading':
+                break
+            time.sleep(0.1)
+
+        self.assertEqual(status['status'], 'done')
+        self.assertGreater(status['version'], previous.version)
+        self.assertIsNot(webserver.data_ingestor, previous)
+        # The cached results of the previous dataset are dropped
+        self.assertEqual(webserver.query_cache.stats()['size'], 0)
+        self.assertEqual(client.post('/api/states_mean?sync=1', json=data).get_json()['data'], expected)
+
+    def test_dataset_loaded_on_first_use(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'data.csv')
+            self.data.head(500).to_csv(csv_path, index=False)
+
+            server = Webserver(__name__, csv_path)
+            self.assertFalse(server.ready.is_set())
+            self.assertEqual(len(server.data_ingestor.data), 500)
+            self.assertTrue(server.ready.is_set())
+
+            missing = Webserver(__name__, os.path.join(directory, 'missing.csv'))
+            with self.assertRaises(FileNotFoundError):
+                missing.data_ingestor
+            self.assertFalse(missing.ready.is_set())
+            self.assertIsInstance(missing.load_error, FileNotFoundError)
+
+        webserver.data_ingestor
+        res = webserver.test_client().get('/api/ready')
+        self.assertEqual(res.status_code, 200)
+        self.assertEqual(res.get_json()['status'], 'ready')
+
+    def test_column_cache_of_the_csv(self):
+        with tempfile.TemporaryDirectory() as directory:
+            csv_path = os.path.join(directory, 'data.csv')
+            self.data.head(500).to_csv(csv_path, index=False)
+            expected = pd.read_csv(csv_path, usecols=list(SCHEMA), dtype=SCHEMA)
+
+            # The first load parses the CSV and saves the columns, the next ones read them
+            self.assertTrue(DataIngestor.read_csv(csv_path).equals(expected))
+            self.assertIsNotNone(ColumnCache(csv_path).load())
+            self.assertTrue(DataIngestor.read_csv(csv_path).equals(expected))
+
+            # A changed CSV is parsed again
+            self.data.head(400).to_csv(csv_path, index=False)
+            self.assertIsNone(ColumnCache(csv_path).load())
+            self.assertEqual(len(DataIngestor.read_csv(csv_path)), 400)
+            self.assertEqual(len(ColumnCache(csv_path).load()), 400)
+
+    @unittest.skipUnless(os.path.exists('/proc/self/status'), 'needs /proc')
+    def test_exported_dataset_shared_with_workers(self):
+        rows = 4000000
+        data = pd.DataFrame({
+            'Question': pd.Categorical.from_codes(np.arange(rows) % 9, webserver.data_ingestor.questions),
+            'LocationDesc': pd.Categorical.from_codes(np.arange(rows) % 2, ['Ohio', 'Texas']),
+            'StratificationCategory1': pd.Categorical.from_codes(np.zeros(rows, dtype='int8'), ['Total']),
+            'Stratification1': pd.Categorical.from_codes(np.zeros(rows, dtype='int8'), ['Total']),
+            'Data_Value': np.random.default_rng(0).random(rows),
+        })
+        data_ingestor = DataIngestor('large.csv', data, {})
+        shared = data_ingestor.export_shared()
+
+        context = multiprocessing.get_context('spawn')
+        deltas = {}
+        try:
+            for workers in (1, 4):
+                barrier = context.Barrier(workers)
+                with ProcessPoolExecutor(max_workers=workers, mp_context=context,
+                                         initializer=wait_for_workers, initargs=(barrier,)) as executor:
+                    futures = [executor.submit(attach_and_read, shared) for _ in range(workers)]
+                    results = [future.result() for future in futures]
+                for delta, total, codes in results:
+                    self.assertEqual(total, data['Data_Value'].sum())
+                    self.assertEqual(codes, 8)
+                deltas[workers] = max(delta for delta, _, _ in results)
+        finally:
+            shared.close()
+
+        # The workers read the columns without making a private copy of them, so adding
+        # workers does not add a copy of the dataset per worker
+        nbytes = data['Data_Value'].nbytes
+        self.assertLess(deltas[1], nbytes // 2)
+        self.assertLess(deltas[4], nbytes // 2)
+        self.assertLess(deltas[4], deltas[1] + nbytes // 8)
+
+    def test_memory_result_store_eviction(self):
+        store = MemoryResultStore(2, 0)
+        store.put('1', b'{"a":1}')
+        store.put('2', b'{"b":2}')
+        store.put('3', b'{"c":3}')
+
+        self.assertEqual(store.get('3'), b'{"c":3}')
+        with self.assertRaises(KeyError):
+            store.get('1')
+
+        store = MemoryResultStore(10, 0.01)
+        store.put('1', b'{"a":1}')
+        time.sleep(0.02)
+        with self.assertRaises(KeyError):
+            store.get('1')
+
+    def test_identical_jobs_coalesced(self):
+        pool, gate, blocking = single_worker_pool()
+        executions = []
+
+        def counted(data):
+            executions.append(data)
+            return {'question': data['question']}
+
+        blocker = pool.add_task({}, blocking)
+        job_ids = [pool.add_task({'question': 'q'}, counted) for _ in range(3)]
+        other = pool.add_task({'question': 'other'}, counted)
+        self.assertEqual(len(set(job_ids)), 3)
+        self.assertEqual(pool.scheduler_stats()['coalesced'], 2)
+
+        # An interactive job sharing a queued bulk task moves it to the interactive class
+        bulk = pool.add_task({'question': 'urgent'}, counted, 'bulk')
+        urgent = pool.add_task({'question': 'urgent'}, counted, 'interactive')
+        classes = pool.scheduler_stats()['classes']
+        self.assertEqual((classes['interactive']['queued'], classes['bulk']['queued']), (1, 0))
+
+        gate.set()
+        for job_id in [blocker, other, bulk, urgent] + job_ids:
+            self.assertTrue(pool.wait_for_task(str(job_id), 10))
+        pool.graceful_shutdown()
+
+        self.assertEqual(executions[0], {'question': 'urgent'})
+        self.assertEqual(len(executions), 3)
+        for job_id in job_ids:
+            self.assertEqual(pool.get_result(str(job_id)), b'{"question":"q"}')
+            self.assertEqual(pool.get_task_status(str(job_id))['status'], 'done')
+
+        # Once the job is done, an identical one runs again
+        self.assertEqual(pool.in_flight, {})
+
+    def test_scheduler_priority_and_fair_queuing(self):
+        pool, gate, blocking = single_worker_pool()
+        order = []
+
+        def record(data):
+            order.append(data['name'])
+
+        blocker = pool.add_task({}, blocking)
+        job_ids = [pool.add_task({'name': 'a1'}, record, 'bulk', 'a'),
+                   pool.add_task({'name': 'a2'}, record, 'bulk', 'a'),
+                   pool.add_task({'name': 'a3'}, record, 'bulk', 'a'),
+                   pool.add_task({'name': 'b1'}, record, 'bulk', 'b'),
+                   pool.add_task({'name': 'c1'}, record, 'interactive', 'c')]
+
+        stats = pool.scheduler_stats()
+        self.assertEqual(stats['running'], 1)
+        self.assertEqual(stats['classes']['bulk']['queued'], 4)
+        self.assertEqual(stats['classes']['bulk']['clients'], 2)
+
+        gate.set()
+        for job_id in [blocker] + job_ids:
+            self.assertTrue(pool.wait_for_task(str(job_id), 10))
+        pool.graceful_shutdown()
+
+        # The interactive job goes first, then the clients of the bulk class take turns
+        self.assertEqual(order, ['c1', 'a1', 'b1', 'a2', 'a3'])
+        self.assertEqual(pool.scheduler_stats()['classes']['bulk']['dispatched'], 4)
+
+    def test_write_behind_result_store(self):
+        with tempfile.TemporaryDirectory() as directory:
+            store = WriteBehindResultStore(MemoryResultStore(1, 0), DiskResultStore(directory))
+            store.put('1', b'{"a":1}')
+            store.put('2', b'{"b":2}')
+            store.flush()
+
+            # Evicted from memory, but still persisted on disk
+            self.assertEqual(store.get('1'), b'{"a":1}')
+            with open(f'{directory}/2.json') as f:
+                self.assertEqual(json.load(f), {'b': 2})
+
+            # The removal runs after the write still queued
+            store.put('3', b'{"c":3}')
+            store.delete('3')
+            store.flush()
+            self.assertFalse(os.path.exists(f'{directory}/3.json'))
+
+            # A failed write does not stop the writer
+            def failing_put(job_id, result):
+                raise OSError('disk full')
+
+            disk_put = store.disk.put
+            store.disk.put = failing_put
+            store.put('4', b'{"d":4}')
+            store.flush()
+            store.disk.put = disk_put
+            store.put('5', b'{"e":5}')
+            store.flush()
+            self.assertFalse(os.path.exists(f'{directory}/4.json'))
+            self.assertTrue(os.path.exists(f'{directory}/5.json'))
+
+    def test_encoded_result_spliced_into_response(self):
+        data = {'question': self.data['Question'].iloc[0]}
+        client = webserver.test_client()
+
+        job_id = client.post('/api/mean_by_category', json=data).get_json()['job_id']
+        while True:
+            res = client.get(f'/api/get_results/{job_id}')
+            if res.get_json()['status'] == 'done':
+                break
+            time.sleep(0.01)
+
+        # Same JSON as jsonify would have produced from the decoded result, with the keys in
+        # the same order, though the floats may be written differently
+        with webserver.app_context():
+            expected = jsonify({'status': 'done', 'data': routes.api_mean_by_category(data)})
+
+        self.assertEqual(res.mimetype, 'application/json')
+        self.assertEqual(json.loads(res.get_data()), json.loads(expected.get_data()))
+        self.assertEqual(list(json.loads(res.get_data())), ['data', 'status'])
+
+    def test_job_table_retention(self):
+        table = JobTable()
+        job_ids = [table.add('running') for _ in range(5)]
+        for job_id in job_ids[:4]:
+            table.set_status(job_id, 'done')
+
+        # The running job is kept even if the table is over the limit
+        self.assertEqual(table.expired(1, 0), job_ids[:4])
+        self.assertEqual(table.expired(3, 0), job_ids[:2])
+
+        table.remove(job_ids[:2])
+        self.assertEqual(sorted(table.snapshot()), ['3', '4', '5'])
+
+    def test_jobs_pagination(self):
+        table = JobTable()
+        for _ in range(5):
+            table.add('done')
+
+        jobs, cursor = table.page(0, 2)
+        self.assertEqual(list(jobs), ['1', '2'])
+        jobs, cursor = table.page(cursor, 2)
+        self.assertEqual(list(jobs), ['3', '4'])
+        jobs, cursor = table.page(cursor, 2)
+        self.assertEqual((list(jobs), cursor), (['5'], None))
+
+        res = webserver.test_client().get('/api/jobs?limit=1').get_json()
+        self.assertEqual(len(res['jobs']), min(1, len(webserver.tasks_runner.jobs)))
+
     def test_api_mean_by_category(self):
         with open('./tests/mean_by_category/input/in-1.json') as f:
             data = json.load(f)